@@ -1,32 +1,67 @@
-import json  # Import the json module to work with JSON data
-import uuid  # Import the uuid module to generate unique IDs
 import argparse  # Import the argparse module to handle command-line arguments
+import itertools  # Import itertools to page through results lazily
+import json  # Import the json module for machine-readable statistics and batch commands
+import os  # Import the os module to reset saved metrics
+import shlex  # Import shlex to split shell commands like a terminal would
+import sys  # Import sys to handle a closed output pipe
+import time  # Import time to measure batch latency
+import telemetry  # Import the operation timings and counters
+from book import Book  # Import the compact book record
+from bulk import FORMATS, detect_format, export_books, import_books, validate_book  # Import the bulk import/export pipeline and validation
+from commands import run_command  # Import the JSON command runner
+from library import SORT_FIELDS, ConflictError  # Import the sort fields and the edit conflict error
+from sharding import create_shards, is_sharded, load_books, open_library, save_books, shard_paths  # Import sharded libraries
+from storage import SQLITE_EXTENSIONS, CorruptLibraryError, JournalStorage, default_library_file, library_file, list_libraries, load_full, migrate_json_to_sqlite, open_storage  # Import the storage backends
 
-# File to store library data
-LIBRARY_FILE = "library.json"
+# File to store library data (a .db/.sqlite path selects the SQLite backend, a .shards manifest a sharded library)
+LIBRARY_FILE = default_library_file()
+
+# Storage backend for the library file, opened on first use
+_storage = None
+
+# Get the storage backend for the library file
+def get_storage():
+    global _storage
+    if _storage is None:
+        # Open the JSON or SQLite backend depending on the file extension
+        _storage = open_storage(LIBRARY_FILE)
+    return _storage
+
+# Indexed library, loaded on first use
+_library = None
+
+# Get the indexed library, loading it from storage once
+def get_library():
+    global _library
+    if _library is None:
+        # A sharded library opens its own storage per shard
+        _library = open_library(LIBRARY_FILE)
+    return _library
+
+# Switch to another library file, e.g. from --library; the next command opens it
+def select_library(name):
+    global LIBRARY_FILE, _storage, _library
+    if _library is not None:
+        _library.save_index()
+    LIBRARY_FILE = library_file(name)
+    _storage = None
+    _library = None
 
 # Load library from file
 def load_library():
-    try:
-        # Open the library file in read mode
-        with open(LIBRARY_FILE, "r") as file:
-            # Load the JSON data from the file and convert it to a Python list
-            return json.load(file)
-    except (FileNotFoundError, json.JSONDecodeError):
-        # If the file does not exist or is empty/invalid, return an empty list
-        return []
+    if is_sharded(LIBRARY_FILE):
+        return load_books(LIBRARY_FILE)
+    # Read every book through the storage backend, with content kept in a separate file filled in
+    return load_full(get_storage())
 
 # Save library to file
 def save_library(library):
-    # Open the library file in write mode
-    with open(LIBRARY_FILE, "w") as file:
-        # Convert the library list to JSON and write it to the file with indentation for readability
-        json.dump(library, file, indent=4)
-
-# Generate a 3-digit unique ID
-def generate_id():
-    # Generate a UUID, convert it to an integer, and take the first 3 digits as the ID
-    return str(uuid.uuid4().int)[:3]
+    if is_sharded(LIBRARY_FILE):
+        # Each book goes to the shard its ID hashes to
+        save_books(LIBRARY_FILE, library)
+        return
+    # Write every book through the storage backend
+    get_storage().save(library)
 
 # Function to get non-empty input
 def get_non_empty_input(prompt):
@@ -48,54 +83,48 @@ def get_valid_year(prompt):
         # If the input is invalid, show an error message and prompt again
         print("Error: Publication year must be a valid number. Please try again.")
 
-# Add a new book
-def add_book():
+# Add a new book, prompting for any field not given on the command line
+def add_book(title=None, author=None, year=None, genre=None, content=None, read_status=None):
+    given_as_flags = any(value is not None for value in (title, author, year, genre, content))
     # Get the book title from the user (non-empty)
-    title = get_non_empty_input("Enter the title of the book: ")
+    if title is None:
+        title = get_non_empty_input("Enter the title of the book: ")
     # Get the book author from the user (non-empty)
-    author = get_non_empty_input("Enter the author of the book: ")
+    if author is None:
+        author = get_non_empty_input("Enter the author of the book: ")
     # Get the publication year from the user (valid number)
-    year = get_valid_year("Enter the publication year of the book: ")
+    if year is None:
+        year = get_valid_year("Enter the publication year of the book: ")
     # Get the book genre from the user (non-empty)
-    genre = get_non_empty_input("Enter the genre of the book: ")
+    if genre is None:
+        genre = get_non_empty_input("Enter the genre of the book: ")
     # Get the book content from the user (non-empty)
-    content = get_non_empty_input("Enter the content of the book: ")
-    # Ask if the user has read the book and convert the response to a boolean
-    read_status = input("Have you read this book? (yes/no): ").lower() == "yes"
+    if content is None:
+        content = get_non_empty_input("Enter the content of the book: ")
+    # Ask if the user has read the book and convert the response to a boolean;
+    # a book given with field flags is unread unless --read says otherwise, so scripts never hit the prompt
+    if read_status is None and given_as_flags:
+        read_status = False
+    if read_status is None:
+        read_status = input("Have you read this book? (yes/no): ").lower() == "yes"
 
-    # Load the existing library
-    library = load_library()
-    # Generate a unique ID for the new book
-    book_id = generate_id()
-    # Add the new book to the library
-    library.append({
-        "id": book_id,
-        "title": title,
-        "author": author,
-        "year": year,
-        "genre": genre,
-        "content": content,
-        "read": read_status
-    })
-    # Save the updated library to the file
-    save_library(library)
+    # Check values given as flags with the same rules as the prompts, and generate a unique ID
+    book, error = validate_book({"title": title, "author": author, "year": year, "genre": genre, "content": content, "read": read_status})
+    if error:
+        print(f"Error: {error.capitalize()}.")
+        return
+    # Add the new book to the library as a single record
+    book = get_library().add(Book.from_dict(book))
     # Notify the user that the book has been added successfully
-    print(f"Book added successfully! ID: {book_id}")
+    print(f"Book added successfully! ID: {book.id}")
 
 # Remove a book
-def remove_book():
+def remove_book(book_id=None):
     # Get the ID of the book to remove from the user
-    book_id = input("Enter the ID of the book to remove: ")
-    # Load the existing library
-    library = load_library()
-    # Track the initial number of books in the library
-    initial_count = len(library)
-    # Filter out the book with the given ID
-    library = [book for book in library if book["id"] != book_id]
-    # Check if a book was actually removed
-    if len(library) < initial_count:
-        # Save the updated library to the file
-        save_library(library)
+    if book_id is None:
+        book_id = input("Enter the ID of the book to remove: ")
+    # Remove the book with the given ID and check if a book was actually removed
+    if get_library().remove(book_id):
         # Notify the user that the book has been removed successfully
         print("Book removed successfully!")
     else:
@@ -103,158 +132,515 @@ def remove_book():
         print("Book not found!")
 
 # Search for a book
-def search_book():
-    # Get the search term from the user (title, author, or ID)
-    search_term = input("Enter the title, author, or ID to search: ").strip()
+def search_book(search_term=None, fuzzy=False, limit=None):
+    # Get the search term from the user (words from the title, author, genre or content, or an ID)
+    if search_term is None:
+        search_term = input("Enter the title, author, or ID to search: ")
+    search_term = search_term.strip()
     if not search_term:  # If the search term is blank
         # Notify the user that no book was found
         print("Book not found!")
         return
 
-    # Load the existing library
-    library = load_library()
-    # Search for books that match the search term in title, author, or ID
-    results = [book for book in library if search_term.lower() in book["title"].lower() or search_term.lower() in book["author"].lower() or search_term == book["id"]]
+    # Search the full-text index, best matches first (optionally tolerating typos)
+    library = get_library()
+    results = library.search(search_term, limit, fuzzy)
     if results:
         # If matching books are found, display their details
         for book in results:
             print(f"""
-            Title: {book['title']}
-            Author: {book['author']}
-            Year: {book['year']}
-            Genre: {book['genre']}
-            Read: {'✅ Read' if book['read'] else '❌ Unread'}
-            ID: {book['id']}
-            Content: {book['content']}
+            Title: {book.title}
+            Author: {book.author}
+            Year: {book.year}
+            Genre: {book.genre}
+            Read: {'✅ Read' if book.read else '❌ Unread'}
+            ID: {book.id}
+            Content: {library.content(book)}
             """)
     else:
         # If no matching books are found, notify the user
         print("No matching books found!")
 
-# Update a book
-def update_book():
+# Update a book; with an ID and field flags it runs without prompting
+def update_book(book_id=None, **changes):
     # Get the ID of the book to update from the user
-    book_id = input("Enter the ID of the book to update: ")
-    # Load the existing library
-    library = load_library()
+    if book_id is None:
+        book_id = input("Enter the ID of the book to update: ")
     # Find the book with the given ID
-    book = next((book for book in library if book["id"] == book_id), None)
-    if book:
+    book = get_library().get(book_id)
+    if book is None:
+        # If the book is not found, notify the user
+        print("Book not found!")
+        return
+    # Edit a copy with the content filled in, wherever storage keeps it
+    book = get_library().full(book)
+    changes = {field: value for field, value in changes.items() if value is not None}
+    if changes:
+        # Only the fields given as flags change
+        updated, error = validate_book({**book.to_dict(), **changes})
+        if error:
+            print(f"Error: {error.capitalize()}.")
+            return
+        # Keep the version the book was read at
+        book = Book.from_dict({**updated, "version": book.version})
+    else:
         # If the book is found, display its current details and prompt for updates
-        print(f"Current Title: {book['title']}")
-        title = get_non_empty_input("Enter the new title (or press Enter to keep current): ") or book["title"]
-        print(f"Current Author: {book['author']}")
-        author = get_non_empty_input("Enter the new author (or press Enter to keep current): ") or book["author"]
-        print(f"Current Year: {book['year']}")
-        year = get_valid_year("Enter the new publication year (or press Enter to keep current): ") or book["year"]
-        print(f"Current Genre: {book['genre']}")
-        genre = get_non_empty_input("Enter the new genre (or press Enter to keep current): ") or book["genre"]
-        print(f"Current Content: {book['content']}")
-        content = get_non_empty_input("Enter the new content (or press Enter to keep current): ") or book["content"]
-        print(f"Current Read Status: {'Read' if book['read'] else 'Unread'}")
+        print(f"Current Title: {book.title}")
+        title = get_non_empty_input("Enter the new title (or press Enter to keep current): ") or book.title
+        print(f"Current Author: {book.author}")
+        author = get_non_empty_input("Enter the new author (or press Enter to keep current): ") or book.author
+        print(f"Current Year: {book.year}")
+        year = get_valid_year("Enter the new publication year (or press Enter to keep current): ") or book.year
+        print(f"Current Genre: {book.genre}")
+        genre = get_non_empty_input("Enter the new genre (or press Enter to keep current): ") or book.genre
+        print(f"Current Content: {book.content}")
+        content = get_non_empty_input("Enter the new content (or press Enter to keep current): ") or book.content
+        print(f"Current Read Status: {'Read' if book.read else 'Unread'}")
         read_status = input("Mark as read? (yes/no): ").lower() == "yes"
 
-        # Update the book's details
-        book.update({
-            "title": title,
-            "author": author,
-            "year": year,
-            "genre": genre,
-            "content": content,
-            "read": read_status
-        })
-        # Save the updated library to the file
-        save_library(library)
-        # Notify the user that the book has been updated successfully
-        print("Book updated successfully!")
-    else:
-        # If the book is not found, notify the user
-        print("Book not found!")
+        # Build the updated record (the indexed original must stay intact until it is replaced)
+        book = book.with_changes(
+            title=title,
+            author=author,
+            year=year,
+            genre=genre,
+            content=content,
+            read=read_status
+        )
+    try:
+        # Save the updated book; it still carries the version it was read at
+        get_library().update(book)
+    except ConflictError as error:
+        # Someone else changed the book while it was being edited
+        print(f"Error: {error}")
+        return
+    # Notify the user that the book has been updated successfully
+    print("Book updated successfully!")
+
+# Apply a stream of JSON-lines commands against one loaded library, with one final write
+def run_batch(path=None):
+    file = sys.stdin if path in (None, "-") else open(path, "r", encoding="utf-8")
+    library = get_library()
+    start = time.perf_counter()
+    count = failed = 0
+    try:
+        # Every change is held in memory and written to storage once at the end
+        with library.transaction():
+            for line in file:
+                if not line.strip():
+                    continue
+                try:
+                    result = run_command(library, json.loads(line))
+                except json.JSONDecodeError:
+                    result = {"ok": False, "error": "invalid JSON"}
+                # One JSON result per command, in order
+                print(json.dumps(result))
+                count += 1
+                failed += not result["ok"]
+    finally:
+        if file is not sys.stdin:
+            file.close()
+    elapsed = time.perf_counter() - start
+    # Keep standard output for the results
+    print(f"Ran {count} commands ({failed} failed) in {elapsed:.2f}s ({elapsed / max(count, 1) * 1000:.3f} ms/command)", file=sys.stderr)
+
+# Keep the library and its indexes loaded and run commands until exit
+def run_shell(parser):
+    print("Personal Library Manager shell. Enter a command (e.g. search --query python), a JSON command, or exit.")
+    while True:
+        try:
+            line = input("library> ").strip()
+        except EOFError:
+            break
+        if not line:
+            continue
+        if line in ("exit", "quit"):
+            break
+        if line.startswith("{"):
+            # JSON commands use the same format as batch mode
+            try:
+                result = run_command(get_library(), json.loads(line))
+            except json.JSONDecodeError:
+                result = {"ok": False, "error": "invalid JSON"}
+            except CorruptLibraryError as error:
+                result = {"ok": False, "error": str(error)}
+            print(json.dumps(result))
+            continue
+        try:
+            args = parser.parse_args(shlex.split(line))
+        except ValueError as error:
+            # Unbalanced quotes
+            print(f"Error: {error}")
+            continue
+        except SystemExit:
+            # argparse has already printed the problem or the help text
+            continue
+        if args.command == "shell":
+            print("Already in the shell.")
+            continue
+        try:
+            with telemetry.timer(f"cli.{args.command}"):
+                run(parser, args)
+        except Exception as error:
+            # One failed command must not end the session
+            print(f"Error: {error}")
+
+# Format books one at a time so output can be streamed into a pager
+def format_books(books, show_content=False):
+    for book in books:
+        text = f"""
+            Title: {book.title}
+            Author: {book.author}
+            Year: {book.year}
+            Genre: {book.genre}
+            Read: {'✅ Read' if book.read else '❌ Unread'}
+            ID: {book.id}"""
+        # Book bodies can be long, so only include them when asked
+        if show_content:
+            text += f"""
+            Content: {get_library().content(book)}"""
+        yield text + "\n"
 
 # Display all books
-def display_all_books():
+def display_all_books(limit=None, offset=0, sort_by=None, descending=False, show_content=False, **filters):
     # Load the existing library
-    library = load_library()
+    library = get_library()
     if library:
-        # If the library is not empty, display details of all books
-        for book in library:
-            print(f"""
-            Title: {book['title']}
-            Author: {book['author']}
-            Year: {book['year']}
-            Genre: {book['genre']}
-            Read: {'✅ Read' if book['read'] else '❌ Unread'}
-            ID: {book['id']}
-            Content: {book['content']}
-            """)
+        # Stream the matching books without building the full output in memory
+        books = itertools.islice(library.query(sort_by, descending, **filters), offset, None if limit is None else offset + limit)
+        shown = 0
+        try:
+            for text in format_books(books, show_content):
+                print(text, flush=True)
+                shown += 1
+        except BrokenPipeError:
+            # The pager was closed before the end of the list; stop quietly
+            sys.stdout = None
+            return
+        if not shown:
+            # Nothing matched the filters or the page is past the end
+            print("No matching books found!")
     else:
         # If the library is empty, notify the user
         print("Your library is empty!")
 
 # Display library statistics
-def display_statistics():
-    # Load the existing library
-    library = load_library()
-    # Calculate the total number of books
-    total_books = len(library)
-    # Calculate the number of read books
-    read_books = sum(1 for book in library if book["read"])
-
-    # Calculate the percentage of read books
-    if total_books > 0:
-        read_percentage = (read_books / total_books) * 100
-    else:
-        read_percentage = 0
+def display_statistics(as_json=False):
+    # Read the running totals the library keeps up to date
+    summary = get_library().stats.summary()
+    if as_json:
+        # Machine-readable output for scripts
+        print(json.dumps(summary, indent=4))
+        return
 
     # Display the total number of books and the percentage of read books
-    print(f"Total books: {total_books}")
-    print(f"Percentage read: {read_percentage:.1f}%")
+    print(f"Total books: {summary['total']}")
+    print(f"Percentage read: {summary['read_percentage']:.1f}%")
+    print(f"Read: {summary['read']}  Unread: {summary['unread']}")
+    # Display the most common genres and authors, and the books per decade
+    for title, counts in (("Top genres", summary["genres"]), ("Top authors", summary["authors"])):
+        if counts:
+            print(f"{title}:")
+            for value, count in list(counts.items())[:5]:
+                print(f"  {value}: {count}")
+    if summary["decades"]:
+        print("Books per decade:")
+        for decade, count in summary["decades"].items():
+            print(f"  {decade}: {count}")
 
-# Main function to handle CLI
-def main():
+# File where CLI runs add up their metrics, next to the library
+def metrics_file():
+    return LIBRARY_FILE + ".metrics"
+
+# Display the operation timings, counters and slow operations
+def display_metrics(as_json=False, reset=False):
+    if reset:
+        # Forget the saved metrics and the ones from this process
+        try:
+            os.remove(metrics_file())
+        except FileNotFoundError:
+            pass
+        telemetry.reset()
+        print("Metrics reset.")
+        return
+    # Metrics saved by earlier CLI runs plus the ones from this process (e.g. in the shell)
+    metrics = telemetry.merge(telemetry.load(metrics_file()), telemetry.snapshot())
+    if as_json:
+        print(json.dumps({**metrics, "summary": telemetry.summarize(metrics)}, indent=4))
+        return
+    if not metrics["timings"]:
+        print("No metrics recorded yet." if telemetry.enabled else "No metrics recorded yet. Set LIBRARY_TELEMETRY=1 to record them.")
+        return
+    # Timings, slowest total first
+    print(f"{'operation':<24} {'calls':>8} {'mean ms':>10} {'p50 ms':>10} {'p95 ms':>10} {'max ms':>10}")
+    for row in telemetry.summarize(metrics):
+        print(f"{row['operation']:<24} {row['count']:>8} {row['mean_ms']:>10.3f} {row['p50_ms']:>10.3f} {row['p95_ms']:>10.3f} {row['max_ms']:>10.3f}")
+    if metrics["counters"]:
+        print("Counters:")
+        for name, value in sorted(metrics["counters"].items()):
+            print(f"  {name}: {value:,}")
+    if metrics["slow"]:
+        print(f"Slow operations (over {telemetry.slow_ms:.0f} ms), most recent last:")
+        for entry in metrics["slow"][-10:]:
+            print(f"  {entry['at']}  {entry['operation']}  {entry['ms']:.1f} ms")
+
+# Open a file for bulk import/export, with - meaning standard input/output
+def open_bulk_file(path, mode):
+    if path == "-":
+        return sys.stdin if mode == "r" else sys.stdout
+    # csv needs newline="" so quoted line breaks survive
+    return open(path, mode, newline="", encoding="utf-8")
+
+# Import books from a CSV or JSON Lines file
+def import_file(path, file_format=None, batch_size=10000):
+    try:
+        # Work out the format from the extension unless it was given
+        file_format = file_format or detect_format(path)
+    except ValueError as error:
+        print(f"Error: {error}")
+        return
+    file = open_bulk_file(path, "r")
+    try:
+        result = import_books(get_library(), file, file_format, batch_size)
+    finally:
+        if file is not sys.stdin:
+            file.close()
+    # Report the rows that were rejected and the overall throughput
+    for error in result["errors"]:
+        print(error)
+    print(f"Imported {result['imported']} books, rejected {result['rejected']} rows in {result['seconds']:.2f}s ({result['rows_per_second']:,.0f} rows/sec)")
+
+# Export every book to a CSV or JSON Lines file
+def export_file(path, file_format=None):
+    try:
+        # Work out the format from the extension unless it was given
+        file_format = file_format or detect_format(path)
+    except ValueError as error:
+        print(f"Error: {error}")
+        return
+    file = open_bulk_file(path, "w")
+    try:
+        library = get_library()
+        # Fill in each book's content as it is written
+        result = export_books((library.full(book).to_dict() for book in library), file, file_format)
+    finally:
+        if file is not sys.stdout:
+            file.close()
+    # Keep standard output clean for the exported data
+    print(f"Exported {result['exported']} books in {result['seconds']:.2f}s ({result['rows_per_second']:,.0f} rows/sec)", file=sys.stderr)
+
+# Fold one JSON library's journal into a new snapshot and drop replaced book bodies from its content file
+def compact_file(path):
+    global _library
+    # Only the JSON store has a journal to compact
+    if path.lower().endswith(SQLITE_EXTENSIONS):
+        print(f"Compaction only applies to JSON libraries, skipping {path}.")
+        return
+    journal = JournalStorage(path)
+    # Hold the lock so no writer appends while the journal is folded in
+    with journal.lock():
+        before = content_size(journal)
+        journal.compact(content=True)
+    # Books loaded earlier (in the shell) point into the deleted content files; load them again for the next command
+    _library = None
+    print(f"Compacted {journal.journal_path} into {path}")
+    if before:
+        print(f"Content files: {before:,} bytes before, {content_size(journal):,} bytes after")
+
+# Total size of a JSON library's content files
+def content_size(storage):
+    return sum(os.path.getsize(storage.blobs.generation_path(generation)) for generation in storage.blobs.generations())
+
+# List the named libraries, marking the one in use
+def list_library_names():
+    names = list_libraries()
+    if not names:
+        print("No libraries in the libraries directory yet. Create one with --library NAME.")
+    for name in names:
+        print(f"{'*' if library_file(name) == LIBRARY_FILE else ' '} {name}")
+
+# Copy every book of the current library into a new sharded library
+def shard_library(target, shard_count, backend):
+    if shard_count < 1:
+        print("Error: --shards must be at least 1.")
+        return
+    manifest = library_file(target if target.lower().endswith(".shards") else target + ".shards")
+    if os.path.exists(manifest):
+        print(f"Error: {manifest} already exists.")
+        return
+    counts = create_shards(manifest, shard_count, ".db" if backend == "sqlite" else ".json", load_library())
+    print(f"Split {sum(counts)} books into {manifest}: {', '.join(str(count) for count in counts)} per shard")
+    # The exact name to open it by, which stays unambiguous if a library with the bare name exists too
+    name = manifest if os.sep in target or (os.altsep and os.altsep in target) else os.path.basename(manifest)
+    print(f"Open it with --library {name}")
+
+# Add the book field flags shared by the add and update commands
+def add_book_arguments(parser):
+    parser.add_argument("--title", help="Book title")
+    parser.add_argument("--author", help="Book author")
+    parser.add_argument("--year", help="Publication year")
+    parser.add_argument("--genre", help="Book genre")
+    parser.add_argument("--content", help="Book content")
+    read_group = parser.add_mutually_exclusive_group()
+    read_group.add_argument("--read", dest="read", action="store_const", const=True, help="Mark the book as read")
+    read_group.add_argument("--unread", dest="read", action="store_const", const=False, help="Mark the book as unread")
+
+# Build the command-line parser
+def build_parser():
     # Create an argument parser to handle command-line arguments
     parser = argparse.ArgumentParser(description="Personal Library Manager")
+    # Every command can work on a named library instead of the default one
+    parser.add_argument("--library", help="Library name in the libraries directory, or a library file path")
     # Add subparsers for different commands (add, remove, search, update, display, stats)
     subparsers = parser.add_subparsers(dest="command")
 
     # Add a book command
     add_parser = subparsers.add_parser("add", help="Add a new book")
+    add_book_arguments(add_parser)
 
     # Remove a book command
     remove_parser = subparsers.add_parser("remove", help="Remove a book")
+    remove_parser.add_argument("--id", help="ID of the book to remove")
 
     # Search for a book command
     search_parser = subparsers.add_parser("search", help="Search for a book")
+    search_parser.add_argument("--query", help="Words to search for, or a book ID")
+    search_parser.add_argument("--limit", type=int, help="Show at most this many results")
+    search_parser.add_argument("--fuzzy", action="store_true", help="Also match words with small typos")
 
     # Update a book command
     update_parser = subparsers.add_parser("update", help="Update a book")
+    update_parser.add_argument("--id", help="ID of the book to update")
+    add_book_arguments(update_parser)
 
     # Display all books command
     display_parser = subparsers.add_parser("display", help="Display all books")
+    display_parser.add_argument("--limit", type=int, help="Show at most this many books")
+    display_parser.add_argument("--offset", type=int, default=0, help="Skip this many books first")
+    display_parser.add_argument("--sort", choices=SORT_FIELDS, help="Sort by this field")
+    display_parser.add_argument("--desc", action="store_true", help="Sort in descending order")
+    display_parser.add_argument("--author", help="Only show books by this author")
+    display_parser.add_argument("--genre", help="Only show books in this genre")
+    display_parser.add_argument("--year", type=int, help="Only show books from this year")
+    read_group = display_parser.add_mutually_exclusive_group()
+    read_group.add_argument("--read", dest="read", action="store_const", const=True, help="Only show read books")
+    read_group.add_argument("--unread", dest="read", action="store_const", const=False, help="Only show unread books")
+    display_parser.add_argument("--content", action="store_true", help="Include each book's content")
 
     # Display statistics command
     stats_parser = subparsers.add_parser("stats", help="Display library statistics")
+    stats_parser.add_argument("--json", action="store_true", help="Print every aggregate as JSON")
+
+    # Migrate a JSON library into SQLite command
+    migrate_parser = subparsers.add_parser("migrate", help="Copy a JSON library into a SQLite database")
+    migrate_parser.add_argument("--source", default="library.json", help="JSON library file to read")
+    migrate_parser.add_argument("--target", default="library.db", help="SQLite database file to write")
+
+    # Import books from a file command
+    import_parser = subparsers.add_parser("import", help="Import books from a CSV or JSON Lines file")
+    import_parser.add_argument("file", help="File to import, or - for standard input")
+    import_parser.add_argument("--format", choices=sorted(set(FORMATS.values())), help="File format (detected from the extension by default)")
+    import_parser.add_argument("--batch-size", type=int, default=10000, help="Books stored per write")
+
+    # Export books to a file command
+    export_parser = subparsers.add_parser("export", help="Export books to a CSV or JSON Lines file")
+    export_parser.add_argument("file", help="File to write, or - for standard output")
+    export_parser.add_argument("--format", choices=sorted(set(FORMATS.values())), help="File format (detected from the extension by default)")
+
+    # Compact the journal into a new snapshot command
+    compact_parser = subparsers.add_parser("compact", help="Fold the journal into a new library snapshot and drop replaced book bodies")
+
+    # Batch mode command
+    batch_parser = subparsers.add_parser("batch", help="Apply JSON-lines commands with one final write")
+    batch_parser.add_argument("file", nargs="?", default="-", help="File of commands, or - for standard input")
 
-    # Parse the command-line arguments
-    args = parser.parse_args()
+    # Interactive shell command
+    shell_parser = subparsers.add_parser("shell", help="Keep the library loaded and run commands interactively")
 
+    # List the named libraries command
+    subparsers.add_parser("libraries", help="List the libraries in the libraries directory")
+
+    # Split the library into shards command
+    shard_parser = subparsers.add_parser("shard", help="Copy the library into a new library split across several files")
+    shard_parser.add_argument("target", help="Name or path of the new sharded library (.shards is added if missing)")
+    shard_parser.add_argument("--shards", type=int, default=4, help="Number of shard files")
+    shard_parser.add_argument("--backend", choices=["json", "sqlite"], default="json", help="Storage backend of each shard")
+
+    # Telemetry command
+    metrics_parser = subparsers.add_parser("metrics", help="Show operation timings recorded with LIBRARY_TELEMETRY=1")
+    metrics_parser.add_argument("--json", action="store_true", help="Print the metrics as JSON")
+    metrics_parser.add_argument("--reset", action="store_true", help="Clear the recorded metrics")
+
+    return parser
+
+# Run one parsed command
+def run(parser, args):
+    # Switch libraries first; in the shell the choice stays for later commands
+    if args.library is not None:
+        select_library(args.library)
     # Execute the corresponding function based on the command
     if args.command == "add":
-        add_book()
+        add_book(args.title, args.author, args.year, args.genre, args.content, args.read)
     elif args.command == "remove":
-        remove_book()
+        remove_book(args.id)
     elif args.command == "search":
-        search_book()
+        search_book(args.query, args.fuzzy, args.limit)
     elif args.command == "update":
-        update_book()
+        update_book(args.id, title=args.title, author=args.author, year=args.year, genre=args.genre, content=args.content, read=args.read)
     elif args.command == "display":
-        display_all_books()
+        display_all_books(args.limit, args.offset, args.sort, args.desc, args.content, author=args.author, genre=args.genre, year=args.year, read=args.read)
     elif args.command == "stats":
-        display_statistics()
+        display_statistics(args.json)
+    elif args.command == "migrate":
+        # Copy the books and report how many were migrated
+        count = migrate_json_to_sqlite(args.source, args.target)
+        print(f"Migrated {count} books from {args.source} to {args.target}")
+    elif args.command == "import":
+        import_file(args.file, args.format, args.batch_size)
+    elif args.command == "export":
+        export_file(args.file, args.format)
+    elif args.command == "compact":
+        # A sharded library compacts each of its shard files
+        for path in shard_paths(LIBRARY_FILE) if is_sharded(LIBRARY_FILE) else [LIBRARY_FILE]:
+            compact_file(path)
+    elif args.command == "libraries":
+        list_library_names()
+    elif args.command == "shard":
+        shard_library(args.target, args.shards, args.backend)
+    elif args.command == "batch":
+        run_batch(args.file)
+    elif args.command == "shell":
+        run_shell(parser)
+    elif args.command == "metrics":
+        display_metrics(args.json, args.reset)
     else:
         # If no valid command is provided, display the help message
         parser.print_help()
 
+# Main function to handle CLI
+def main(argv=None):
+    # Parse the command-line arguments (or the given ones, as the benchmark does)
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        with telemetry.timer(f"cli.{args.command}"):
+            run(parser, args)
+    except CorruptLibraryError as error:
+        # Stop before anything is written over the damaged file
+        print(f"Error: {error}", file=sys.stderr)
+        sys.exit(1)
+
+    # Write the whole full-text index if this command built it or caught it up from a long change log
+    if _library is not None:
+        try:
+            _library.save_index()
+        except OSError as error:
+            # The command itself succeeded; the index is rebuilt from the books next time
+            print(f"Warning: could not save the search index: {error}", file=sys.stderr)
+    # Add this run's metrics to the saved ones, so `metrics` can show them later
+    if telemetry.enabled and args.command != "metrics":
+        telemetry.save(metrics_file())
+
 # Entry point of the program
 if __name__ == "__main__":
     main()
\ No newline at end of file
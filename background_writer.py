@@ -0,0 +1,153 @@
+import atexit  # Import atexit to write out queued changes when the server stops
+import os  # Import the os module to read the queue size setting
+import queue  # Import queue for the bounded queue of pending changes
+import threading  # Import threading for the writer thread
+import telemetry  # Import the operation timings and counters
+from library import ConflictError  # Import the edit conflict error
+from library_cache import cached_library, get_library  # Import the process-wide library cache
+
+# Most changes waiting to be written; a session adding more waits until there is room
+QUEUE_SIZE = int(os.environ.get("LIBRARY_WRITE_QUEUE", "1000"))
+
+# Most failures kept per session until the session shows them
+MAX_FAILURES = 20
+
+
+# Writes changes made in the Streamlit app on a background thread, so a page never waits for the library to be saved
+class BackgroundWriter:
+    def __init__(self, path):
+        # Library file the changes go to; the library itself is looked up in the cache for every batch
+        self.path = path
+        # Changes waiting to be written, as (session, operation, value) tuples
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        # Failed changes per session, shown on that session's next page
+        self.failed = {}
+        self.lock = threading.Lock()
+        # Daemon thread, so the server can stop; atexit writes out what is left first
+        self.thread = threading.Thread(target=self.run, name=f"library-writer:{path}", daemon=True)
+        self.thread.start()
+
+    # Queue a change and return at once; operation is "add", "update" or "remove"
+    def submit(self, session, operation, value):
+        self.queue.put((session, operation, value))
+
+    # Number of changes not written yet
+    def pending(self):
+        return self.queue.unfinished_tasks
+
+    # Failures of a session's changes since it last asked, oldest first
+    def failures(self, session):
+        with self.lock:
+            return self.failed.pop(session, [])
+
+    # Wait until every queued change is written
+    def flush(self):
+        self.queue.join()
+
+    # Write out the remaining changes, stop the thread and save the full-text index
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.save_index()
+
+    # Write the whole full-text index if it was built or caught up while serving pages
+    # Done at shutdown rather than after each batch: batches log their index changes, and a full write grows with the library
+    def save_index(self):
+        library = cached_library(self.path)
+        if library is None:
+            return
+        try:
+            library.save_index()
+        except OSError:
+            # The books are saved; the index is rebuilt from them on the next load
+            pass
+
+    # Take every change waiting now; changes made while the last write ran end up in the same batch
+    def take_batch(self):
+        batch = [self.queue.get()]
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+    # Write batches until closed
+    def run(self):
+        while True:
+            batch = self.take_batch()
+            changes = [change for change in batch if change is not None]
+            if changes:
+                self.write(changes)
+            for _ in batch:
+                self.queue.task_done()
+            if len(changes) < len(batch):
+                # Closed; everything queued before close() has been written
+                return
+
+    # Apply a batch of changes in one transaction, so the whole burst reaches storage in one write
+    @telemetry.timed("writer.batch")
+    def write(self, changes):
+        telemetry.count("writer.changes", len(changes))
+        changes = self.coalesce(changes)
+        try:
+            library = get_library(self.path)
+            with library.transaction():
+                for session, operation, value in changes:
+                    try:
+                        if operation == "add":
+                            library.add(value)
+                        elif operation == "update":
+                            if not library.update(value):
+                                self.fail(session, f"{value.title}: the book was removed before the change was saved")
+                        else:
+                            library.remove(value)
+                    except ConflictError as error:
+                        # Only this change is dropped; the rest of the batch is still written
+                        self.fail(session, str(error))
+        except Exception as error:
+            # Nothing in the batch reached storage
+            for session, operation, value in changes:
+                self.fail(session, f"Could not save a change ({operation}): {error}")
+            return
+
+    # Keep only the last of several edits a session made to the same version of a book
+    @staticmethod
+    def coalesce(changes):
+        latest = {}
+        for position, (session, operation, value) in enumerate(changes):
+            if operation == "update":
+                latest[(session, value.id, value.version)] = position
+        return [change for position, change in enumerate(changes) if change[1] != "update" or latest[(change[0], change[2].id, change[2].version)] == position]
+
+    # Remember a failure for the session that made the change
+    def fail(self, session, message):
+        telemetry.count("writer.failures")
+        with self.lock:
+            failures = self.failed.setdefault(session, [])
+            failures.append(message)
+            del failures[:-MAX_FAILURES]
+
+
+# One writer per library file, shared by every session in this process
+_writers = {}
+
+# Guards the writers above
+_lock = threading.Lock()
+
+
+# Get the background writer for a library file, starting it on first use
+def get_writer(path):
+    with _lock:
+        writer = _writers.get(path)
+        if writer is None:
+            writer = _writers[path] = BackgroundWriter(path)
+        return writer
+
+
+# Write out every queued change when the process exits
+@atexit.register
+def close_all():
+    with _lock:
+        writers = list(_writers.values())
+    for writer in writers:
+        writer.close()
@@ -0,0 +1,443 @@
+import argparse  # Import argparse for the benchmark options
+import array  # Import array for the columnar layout in the memory benchmark
+import importlib.util  # Import importlib.util to check whether Streamlit is installed
+import contextlib  # Import contextlib to silence the CLI output while timing it
+import cProfile  # Import cProfile to profile the slowest operation
+import gc  # Import gc to measure memory without leftover garbage
+import json  # Import the json module to write batch commands and results
+import os  # Import the os module to build file paths
+import platform  # Import platform to record where results were measured
+import pstats  # Import pstats to print the profile
+import subprocess  # Import subprocess to run the CLI like a user would
+import sys  # Import sys to find the Python interpreter
+import tempfile  # Import tempfile for throwaway libraries
+import time  # Import time to measure latency
+import tracemalloc  # Import tracemalloc to measure memory use
+from book import Book  # Import the compact book record
+from sharding import PARALLEL_MODES, create_shards, open_library  # Import sharded libraries
+from storage import open_storage  # Import the storage backends
+
+# Directory of this file, and the CLI script next to it
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP = os.path.join(HERE, "app.py")
+
+
+# Build a synthetic library of the given size
+def make_books(count, content_length=200):
+    return [{
+        "id": f"bench-{number}",
+        "title": f"Book {number}",
+        "author": f"Author {number % 500}",
+        "year": 1900 + number % 120,
+        "genre": f"Genre {number % 40}",
+        "content": ("word " * (content_length // 5 + 1))[:content_length],
+        "read": number % 3 == 0,
+        "version": 1,
+    } for number in range(count)]
+
+
+# Yield synthetic metadata records one at a time, shaped like records loaded from a lazy-content store
+def make_records(count):
+    for number in range(count):
+        yield {"id": f"bench-{number:07d}", "title": f"Book {number}", "author": f"Author {number % 500}", "year": 1900 + number % 120, "genre": f"Genre {number % 40}", "read": number % 3 == 0, "version": 1}
+
+
+# Metadata columns in typed arrays, with repeated authors and genres stored once and referenced by number
+class BookTable:
+    def __init__(self, records):
+        self.ids = []
+        self.titles = []
+        self.years = array.array("H")
+        self.reads = array.array("b")
+        self.versions = array.array("I")
+        # Distinct authors and genres, and the number of each in the lists below
+        self.authors, self.author_codes = [], {}
+        self.genres, self.genre_codes = [], {}
+        self.author_column = array.array("I")
+        self.genre_column = array.array("I")
+        for record in records:
+            self.ids.append(record["id"])
+            self.titles.append(record["title"])
+            self.years.append(record["year"])
+            self.reads.append(record["read"])
+            self.versions.append(record["version"])
+            self.author_column.append(self.code(self.authors, self.author_codes, record["author"]))
+            self.genre_column.append(self.code(self.genres, self.genre_codes, record["genre"]))
+
+    # Number for a value, adding it the first time it is seen
+    @staticmethod
+    def code(values, codes, value):
+        if value not in codes:
+            codes[value] = len(values)
+            values.append(value)
+        return codes[value]
+
+
+# Memory held by whatever build() returns, in bytes
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size, elapsed
+
+
+# Compare plain dicts, slotted Book records and a columnar table for the in-memory metadata
+def bench_memory(sizes):
+    layouts = [
+        ("dict list", lambda count: list(make_records(count))),
+        ("slotted Book", lambda count: [Book.from_dict(record) for record in make_records(count)]),
+        ("columnar BookTable", lambda count: BookTable(make_records(count))),
+    ]
+    for count in sizes:
+        baseline = None
+        for name, build in layouts:
+            size, elapsed = measure(lambda: build(count))
+            baseline = baseline or size
+            print(f"{count:>9,} books  {name:<18} {size / 2 ** 20:8.1f} MB  {size / count:6.0f} bytes/book  {size / baseline:5.0%} of dicts  built in {elapsed:.2f}s")
+
+
+# Value below which a share of the samples fall, using the nearest rank
+def percentile(samples, share):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, round(share * len(ordered)) - 1))]
+
+
+# Run one CLI command as `python app.py ...` does: the library is loaded from storage, changed, and the index saved if needed
+def run_command(app, *argv):
+    app._library = None
+    app.main(list(argv))
+
+
+# The CLI operations to time, each called with the iteration number
+def suite_operations(app, books):
+    queries = ["word", "author 7", "genre 12", "book 4321", "autho"]
+    return {
+        # Read every record from storage
+        "load": lambda number: app.load_library(),
+        # Build the in-memory library and its indexes from storage
+        "open": lambda number: (setattr(app, "_library", None), app.get_library()),
+        # First page of the library sorted by title
+        "display": lambda number: app.display_all_books(20, 0, "title"),
+        # Every statistic, as printed by the stats command
+        "stats": lambda number: app.display_statistics(),
+        # Top ten matches for a mix of common, rare and prefix queries
+        "search": lambda number: app.search_book(queries[number % len(queries)], limit=10),
+        # Change one field of an existing book, as a whole command
+        "update": lambda number: run_command(app, "update", "--id", f"bench-{number % books}", "--year", str(1900 + number % 120)),
+        # Add a new book, as a whole command
+        "add": lambda number: run_command(app, "add", "--title", f"New book {number}", "--author", "New author", "--year", "2024", "--genre", "New genre", "--content", "New content", "--unread"),
+        # Remove an existing book, as a whole command
+        "remove": lambda number: run_command(app, "remove", "--id", f"bench-{books - 1 - number}"),
+        # Write every record back to storage
+        "save": lambda number: app.save_library(app.load_library()),
+    }
+
+
+# Time every CLI operation against a synthetic library and return the results
+def bench_suite(books, content_length, repeat, backend, profile=None):
+    # Import the CLI here, after the library file is chosen
+    import app
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "library.db" if backend == "sqlite" else "library.json")
+        os.environ["LIBRARY_JOURNAL"] = "1" if backend == "journal" else "0"
+        open_storage(path).save(make_books(books, content_length))
+        # Point the CLI at the synthetic library
+        app.LIBRARY_FILE = path
+        app._storage = None
+        app._library = None
+        operations = suite_operations(app, books)
+        results = {}
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            for name, operation in operations.items():
+                # One untimed call so one-off work (like building the search index) is not counted
+                operation(repeat)
+                samples = []
+                for number in range(repeat):
+                    start = time.perf_counter()
+                    operation(number)
+                    samples.append(time.perf_counter() - start)
+                # One more call to find the memory the operation needs at its peak
+                tracemalloc.start()
+                operation(repeat + 1)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                results[name] = {
+                    "calls": repeat,
+                    "p50_ms": percentile(samples, 0.50) * 1000,
+                    "p95_ms": percentile(samples, 0.95) * 1000,
+                    "mean_ms": sum(samples) / repeat * 1000,
+                    "ops_per_sec": repeat / sum(samples),
+                    "peak_memory_kb": peak / 1024,
+                }
+            if profile:
+                # Profile the operation with the highest median latency
+                slowest = max(results, key=lambda name: results[name]["p50_ms"])
+                profiler = cProfile.Profile()
+                profiler.enable()
+                for number in range(repeat):
+                    operations[slowest](number)
+                profiler.disable()
+                profiler.dump_stats(profile)
+                results[slowest]["profile"] = profile
+    return {
+        "config": {"books": books, "content_length": content_length, "repeat": repeat, "backend": backend},
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "operations": results,
+    }
+
+
+# Print a results table, with the change in median latency against an earlier run if given
+def print_suite(results, baseline=None, threshold=0.2):
+    config = results["config"]
+    print(f"{config['books']:,} books, {config['content_length']} characters of content, {config['backend']} backend, {config['repeat']} calls per operation")
+    print(f"{'operation':<10} {'p50 ms':>10} {'p95 ms':>10} {'ops/sec':>10} {'peak KB':>10}")
+    regressions = []
+    for name, result in results["operations"].items():
+        line = f"{name:<10} {result['p50_ms']:>10.3f} {result['p95_ms']:>10.3f} {result['ops_per_sec']:>10,.0f} {result['peak_memory_kb']:>10,.0f}"
+        previous = (baseline or {}).get("operations", {}).get(name)
+        if previous:
+            change = result["p50_ms"] / previous["p50_ms"] - 1
+            line += f"  {change:+.0%} vs baseline"
+            if change > threshold:
+                regressions.append(name)
+                line += "  REGRESSION"
+        print(line)
+    return regressions
+
+
+# Median wall time in seconds of running a command in a fresh process
+def startup_time(command, environment, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, env=environment, cwd=HERE, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        samples.append(time.perf_counter() - start)
+    return percentile(samples, 0.50)
+
+
+# Self and cumulative import time per module from python -X importtime, slowest cumulative first
+def import_breakdown(module, environment):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], env=environment, cwd=HERE, capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        # Lines look like "import time:   self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative), int(own), name.rstrip()))
+    return sorted(rows, reverse=True)
+
+
+# Measure how long each entry point takes to start, with a -X importtime breakdown
+def bench_startup(runs, top):
+    # Write bytecode caches so every run measures a warm-disk cold start, not compilation
+    environment = {key: value for key, value in os.environ.items() if key != "PYTHONDONTWRITEBYTECODE"}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "library.json")
+        open_storage(path).save(make_books(1000))
+        environment["LIBRARY_FILE"] = path
+        commands = [
+            ("python (empty)", [sys.executable, "-c", "pass"]),
+            ("import app", [sys.executable, "-c", "import app"]),
+            ("app.py --help", [sys.executable, APP, "--help"]),
+            ("app.py stats (1k books)", [sys.executable, APP, "stats"]),
+        ]
+        modules = ["app"]
+        if importlib.util.find_spec("streamlit") is not None:
+            # Importing main outside `streamlit run` executes the page in bare mode, which still pays every import
+            commands.append(("import main", [sys.executable, "-c", "import main"]))
+            modules.append("main")
+        for name, command in commands:
+            # One untimed run writes the bytecode caches
+            subprocess.run(command, env=environment, cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            print(f"{name:<26} {startup_time(command, environment, runs) * 1000:8.1f} ms (median of {runs})")
+        for module in modules:
+            rows = import_breakdown(module, environment)
+            print(f"\nSlowest imports under `import {module}` (microseconds):")
+            print(f"{'cumulative':>12} {'self':>8}  module")
+            for cumulative, own, name in rows[:top]:
+                print(f"{cumulative:>12,} {own:>8,}  {name}")
+
+
+# Words the sharding benchmark builds book content from, so each search term matches a small share of the books
+SEARCH_WORDS = [f"word{number}" for number in range(2000)]
+
+
+# Yield synthetic books with short, varied content for the sharding benchmark
+def make_catalog(count):
+    for number in range(count):
+        content = " ".join(SEARCH_WORDS[(number * step) % len(SEARCH_WORDS)] for step in (1, 7, 31, 101))
+        yield {"id": f"bench-{number:07d}", "title": f"Book {number}", "author": f"Author {number % 500}", "year": 1900 + number % 120, "genre": f"Genre {number % 40}", "content": content, "read": number % 3 == 0}
+
+
+# Time load, ranked search and statistics on one SQLite file and on the same books split into shards, per fan-out mode
+def bench_shards(books, shard_count, queries):
+    with tempfile.TemporaryDirectory() as directory:
+        single = os.path.join(directory, "library.db")
+        manifest = os.path.join(directory, "library.shards")
+        start = time.perf_counter()
+        catalog = list(make_catalog(books))
+        open_storage(single).save(catalog)
+        create_shards(manifest, shard_count, ".db", catalog)
+        del catalog
+        print(f"Built {books:,} books in one file and in {shard_count} shards in {time.perf_counter() - start:.1f}s ({os.cpu_count()} CPUs)")
+        terms = [SEARCH_WORDS[(number * 37) % len(SEARCH_WORDS)] for number in range(queries)]
+        print(f"{'library':<22} {'load':>9} {'first search':>13} {'searches/sec':>13} {'stats':>10}")
+        for name, path, parallel in [("single file", single, None)] + [(f"{shard_count} shards, {mode}", manifest, mode) for mode in PARALLEL_MODES]:
+            start = time.perf_counter()
+            library = open_library(path, parallel)
+            # Shards load in the background; the first call waits for all of them
+            len(library)
+            load = time.perf_counter() - start
+            # The first search builds each shard's full-text index
+            start = time.perf_counter()
+            library.search("word1", 20)
+            first = time.perf_counter() - start
+            start = time.perf_counter()
+            for term in terms:
+                library.search(term, 20)
+            rate = queries / (time.perf_counter() - start)
+            start = time.perf_counter()
+            library.stats.summary()
+            stats = time.perf_counter() - start
+            print(f"{name:<22} {load:>8.2f}s {first:>12.2f}s {rate:>13,.0f} {stats * 1000:>8.2f}ms")
+            if parallel is not None:
+                library.close()
+
+
+# Compare how long the Streamlit app waits per edit when saving in the request and when queueing for the background writer
+def bench_writer(sizes, edits):
+    # Imported here so the other benchmarks do not start a writer
+    from background_writer import get_writer
+    from library_cache import get_library
+    print(f"{'books':>10} {'save in request':>16} {'queue for writer':>17} {'writer total':>13}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "library.json")
+            open_storage(path).save(make_books(size))
+            library = get_library(path)
+            # Saving in the request, as the pages did before
+            samples = []
+            for number in range(edits):
+                book = library.get(f"bench-{number % size}")
+                start = time.perf_counter()
+                library.update(book.with_changes(year=2000 + number % 20))
+                samples.append(time.perf_counter() - start)
+            in_request = percentile(samples, 0.50)
+            # Queueing the same edits, as the pages do now
+            writer = get_writer(path)
+            samples = []
+            total = time.perf_counter()
+            for number in range(edits):
+                book = get_library(path).get(f"bench-{number % size}")
+                start = time.perf_counter()
+                writer.submit("benchmark", "update", book.with_changes(year=1990 + number % 20))
+                samples.append(time.perf_counter() - start)
+            queued = percentile(samples, 0.50)
+            writer.flush()
+            total = time.perf_counter() - total
+            failures = writer.failures("benchmark")
+            writer.close()
+        print(f"{size:>10,} {in_request * 1000:>14.2f}ms {queued * 1000:>15.3f}ms {total * 1000:>11.1f}ms" + (f"  ({len(failures)} failed)" if failures else ""))
+
+
+# Compare one process per edit with a single batch process applying the same edits
+def bench_batch(books, edits):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "library.json")
+        open_storage(path).save(make_books(books))
+        environment = {**os.environ, "LIBRARY_FILE": path}
+
+        # Today's flow: start the CLI once for every edit
+        start = time.perf_counter()
+        for number in range(edits):
+            subprocess.run([sys.executable, APP, "update", "--id", f"bench-{number % books}", "--year", str(2000 + number % 20)], env=environment, check=True, stdout=subprocess.DEVNULL)
+        per_process = (time.perf_counter() - start) / edits
+
+        # Batch mode: one process, one load and one final write
+        commands = "".join(json.dumps({"command": "update", "id": f"bench-{number % books}", "year": 1990 + number % 20}) + "\n" for number in range(edits))
+        start = time.perf_counter()
+        subprocess.run([sys.executable, APP, "batch"], input=commands, text=True, env=environment, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        per_batch = (time.perf_counter() - start) / edits
+
+    print(f"{edits} edits on {books} books: {per_process * 1000:.1f} ms/edit one process per edit, {per_batch * 1000:.2f} ms/edit in batch mode ({per_process / per_batch:.0f}x faster)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Personal Library Manager benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark")
+
+    # Batch mode against one process per edit
+    batch_parser = subparsers.add_parser("batch", help="Compare batch mode with one process per edit")
+    batch_parser.add_argument("--books", type=int, default=10000, help="Number of books in the library")
+    batch_parser.add_argument("--edits", type=int, default=50, help="Number of edits to apply")
+
+    # In-memory record layouts
+    memory_parser = subparsers.add_parser("memory", help="Compare the memory used by dict, slotted and columnar book records")
+    memory_parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="Library sizes to measure")
+
+    # Every CLI operation, with results saved for later comparison
+    suite_parser = subparsers.add_parser("suite", help="Time every library operation and save the results as JSON")
+    suite_parser.add_argument("--books", type=int, default=10000, help="Number of books in the library")
+    suite_parser.add_argument("--content-length", type=int, default=200, help="Characters of content per book")
+    suite_parser.add_argument("--repeat", type=int, default=20, help="Timed calls per operation")
+    suite_parser.add_argument("--backend", choices=["json", "journal", "sqlite"], default="json", help="Storage backend to measure")
+    suite_parser.add_argument("--output", default="benchmark_results.json", help="File to save the results to")
+    suite_parser.add_argument("--compare", help="Earlier results file to compare against")
+    suite_parser.add_argument("--threshold", type=float, default=0.2, help="Slowdown in median latency reported as a regression (0.2 = 20%%)")
+    suite_parser.add_argument("--profile", nargs="?", const="benchmark.prof", help="Profile the slowest operation and write the cProfile output to this file")
+
+    # Cold start of the entry points
+    startup_parser = subparsers.add_parser("startup", help="Time how long the entry points take to start, with an import-time breakdown")
+    startup_parser.add_argument("--runs", type=int, default=20, help="Fresh processes per measurement")
+    startup_parser.add_argument("--top", type=int, default=15, help="Number of imports to list in the breakdown")
+
+    # Sharded library against a single file
+    shards_parser = subparsers.add_parser("shards", help="Compare search and statistics on one file with a sharded library in each fan-out mode")
+    shards_parser.add_argument("--books", type=int, default=1000000, help="Number of books in the library")
+    shards_parser.add_argument("--shards", type=int, default=4, help="Number of shards")
+    shards_parser.add_argument("--queries", type=int, default=200, help="Timed searches per library")
+
+    # Background writer against saving in the request
+    writer_parser = subparsers.add_parser("writer", help="Compare edit latency in the Streamlit app with and without the background writer")
+    writer_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="Library sizes to measure")
+    writer_parser.add_argument("--edits", type=int, default=50, help="Edits per library size")
+
+    args = parser.parse_args()
+    if args.benchmark == "startup":
+        bench_startup(args.runs, args.top)
+    elif args.benchmark == "suite":
+        results = bench_suite(args.books, args.content_length, args.repeat, args.backend, args.profile)
+        baseline = None
+        if args.compare:
+            with open(args.compare, "r") as file:
+                baseline = json.load(file)
+        regressions = print_suite(results, baseline, args.threshold)
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
+        print(f"Results saved to {args.output}")
+        if args.profile:
+            slowest = next(name for name, result in results["operations"].items() if "profile" in result)
+            print(f"Profile of {slowest} written to {args.profile}; top functions by cumulative time:")
+            pstats.Stats(args.profile).sort_stats("cumulative").print_stats(15)
+        # A non-zero exit lets a script or CI job fail on a slowdown
+        if regressions:
+            sys.exit(1)
+    elif args.benchmark == "batch":
+        bench_batch(args.books, args.edits)
+    elif args.benchmark == "memory":
+        bench_memory(args.sizes)
+    elif args.benchmark == "writer":
+        bench_writer(args.sizes, args.edits)
+    elif args.benchmark == "shards":
+        bench_shards(args.books, args.shards, args.queries)
+    else:
+        parser.print_help()
@@ -0,0 +1,137 @@
+import mmap  # Import mmap to read book bodies without loading the whole file
+import os  # Import the os module for file sizes and syncing
+import threading  # Import threading so concurrent readers do not remap under each other
+import zlib  # Import zlib for optional compression
+
+
+# Append-only files of book bodies, addressed by [offset, length, codec] references
+# Compaction copies the bodies still in use to a new numbered file, and references into it carry that number
+# as a fourth element ([offset, length, codec, generation]); references without one point into the first file
+class BlobStore:
+    def __init__(self, path, compress=False):
+        # Remember the path of the first content file; later ones are path.1, path.2 and so on
+        self.path = path
+        # Compress new bodies with zlib when asked
+        self.compress = compress
+        # Unbuffered append handle, opened on the first write, and the number of the file it appends to
+        self.writer = None
+        self.generation = None
+        # Set when records were reloaded; the next write then looks for the newest file again
+        self.stale = False
+        # Open file and memory map per content file number, remapped when the file grows
+        self.maps = {}
+        # Held while reading from or replacing the memory maps
+        self.map_lock = threading.Lock()
+
+    # Path of a numbered content file
+    def generation_path(self, generation):
+        return self.path if generation == 0 else f"{self.path}.{generation}"
+
+    # Numbers of the content files on disk, in order
+    def generations(self):
+        directory, name = os.path.split(os.path.abspath(self.path))
+        found = [0] if os.path.exists(self.path) else []
+        for entry in os.listdir(directory):
+            suffix = entry[len(name) + 1:]
+            if entry.startswith(name + ".") and suffix.isdigit():
+                found.append(int(suffix))
+        return sorted(found)
+
+    # Have the next write look for the newest file again; called whenever records are reloaded, since another process
+    # may have compacted the content in the meantime (only writers, who hold the library lock, touch the append handle)
+    def reset(self):
+        self.stale = True
+        # Let go of content files that compaction has deleted, so their disk space is freed
+        with self.map_lock:
+            for generation in [generation for generation in self.maps if not os.path.exists(self.generation_path(generation))]:
+                self.close_map(generation)
+
+    # Append a body and return the reference to store in the book record
+    def put(self, text):
+        data = text.encode("utf-8")
+        codec = "raw"
+        if self.compress:
+            data = zlib.compress(data)
+            codec = "zlib"
+        if self.stale:
+            self.close_writer()
+        if self.writer is None:
+            if self.generation is None:
+                self.generation = max(self.generations(), default=0)
+            # Unbuffered, so every write lands at the current end of the file even if another process appended
+            self.writer = open(self.generation_path(self.generation), "ab", buffering=0)
+        # Callers hold the library lock, so the file size is where this write will start
+        offset = os.fstat(self.writer.fileno()).st_size
+        self.writer.write(data)
+        return [offset, len(data), codec] if self.generation == 0 else [offset, len(data), codec, self.generation]
+
+    # Close the append handle and forget which file it appended to
+    def close_writer(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.generation = None
+        self.stale = False
+
+    # Make sure every appended body is on disk before records pointing at it are saved
+    def sync(self):
+        if self.writer is not None:
+            os.fsync(self.writer.fileno())
+
+    # Read the stored bytes of a body from its reference
+    def get_bytes(self, reference):
+        offset, length = reference[0], reference[1]
+        generation = reference[3] if len(reference) > 3 else 0
+        with self.map_lock:
+            mapped = self.maps.get(generation)
+            if mapped is None or offset + length > len(mapped[1]):
+                mapped = self.remap(generation)
+            return mapped[1][offset:offset + length]
+
+    # Read a body back from its reference
+    def get(self, reference):
+        data = self.get_bytes(reference)
+        return (zlib.decompress(data) if reference[2] == "zlib" else data).decode("utf-8")
+
+    # Copy the bodies the records still refer to into a new content file, and return the records pointing into it
+    # The old files stay until the caller has saved the new records and calls remove_old(), so a crash in between loses nothing
+    def rewrite(self, records):
+        generation = max(self.generations(), default=0) + 1
+        result = []
+        with open(self.generation_path(generation), "wb") as file:
+            for record in records:
+                reference = record.get("content_ref")
+                if reference is not None:
+                    data = self.get_bytes(reference)
+                    # Bodies are copied as stored, compressed or not
+                    record = {**record, "content_ref": [file.tell(), len(data), reference[2], generation]}
+                    file.write(data)
+                result.append(record)
+            file.flush()
+            os.fsync(file.fileno())
+        # New bodies go to the new file from now on
+        self.close_writer()
+        self.generation = generation
+        return result
+
+    # Delete every content file older than the one new bodies go to
+    def remove_old(self):
+        for generation in self.generations():
+            if generation < self.generation:
+                with self.map_lock:
+                    self.close_map(generation)
+                os.remove(self.generation_path(generation))
+
+    # Map a content file again to see bodies appended since it was last mapped
+    def remap(self, generation):
+        self.close_map(generation)
+        file = open(self.generation_path(generation), "rb")
+        mapped = self.maps[generation] = (file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+        return mapped
+
+    # Release the memory map of a content file
+    def close_map(self, generation):
+        mapped = self.maps.pop(generation, None)
+        if mapped is not None:
+            mapped[1].close()
+            mapped[0].close()
@@ -0,0 +1,62 @@
+import sys  # Import sys to share repeated author and genre strings
+
+# Book attributes in constructor order
+BOOK_ATTRIBUTES = ("id", "title", "author", "year", "genre", "read", "version", "content", "content_ref")
+
+
+# One book in memory; slots drop the per-record attribute dict that a plain dict record carries
+# (written out by hand rather than with @dataclass, whose import alone costs about 10 ms of startup)
+class Book:
+    __slots__ = BOOK_ATTRIBUTES
+
+    # version goes up by one on each update, for conflict detection
+    # content is the body, or None when storage keeps it elsewhere
+    # content_ref is where the JSON store keeps the body in its content file, if it does
+    def __init__(self, id, title, author, year, genre, read, version=0, content=None, content_ref=None):
+        self.id = id
+        self.title = title
+        self.author = author
+        self.year = year
+        self.genre = genre
+        self.read = read
+        self.version = version
+        self.content = content
+        self.content_ref = content_ref
+
+    # Build a book from the JSON record shape used by storage and bulk files
+    @classmethod
+    def from_dict(cls, record):
+        # Authors and genres repeat across many books, so every copy shares one string
+        return cls(record["id"], record["title"], sys.intern(record["author"]), record["year"], sys.intern(record["genre"]), record["read"], record.get("version", 0), record.get("content"), record.get("content_ref"))
+
+    # Convert back to the JSON record shape, leaving out the content fields that are not set
+    def to_dict(self):
+        record = {"id": self.id, "title": self.title, "author": self.author, "year": self.year, "genre": self.genre}
+        if self.content is not None:
+            record["content"] = self.content
+        record["read"] = self.read
+        record["version"] = self.version
+        if self.content_ref is not None:
+            record["content_ref"] = self.content_ref
+        return record
+
+    # A copy with some fields changed, e.g. book.with_changes(read=True)
+    def with_changes(self, **changes):
+        book = Book(*(getattr(self, name) for name in BOOK_ATTRIBUTES))
+        for name, value in changes.items():
+            setattr(book, name, value)
+        return book
+
+    # Books are equal when every attribute is
+    def __eq__(self, other):
+        if not isinstance(other, Book):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in BOOK_ATTRIBUTES)
+
+    def __repr__(self):
+        return "Book(" + ", ".join(f"{name}={getattr(self, name)!r}" for name in BOOK_ATTRIBUTES) + ")"
+
+
+# Accept either a Book or a JSON-shaped record
+def as_book(value):
+    return value if isinstance(value, Book) else Book.from_dict(value)
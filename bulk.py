@@ -0,0 +1,135 @@
+import json  # Import the json module for JSON Lines
+import time  # Import time to report throughput
+from ids import generate_id  # Import the book ID generator
+
+# Columns written on export and read on import
+EXPORT_FIELDS = ["id", "title", "author", "year", "genre", "content", "read"]
+
+# Fields that must not be blank, like get_non_empty_input in the CLI
+TEXT_FIELDS = ["title", "author", "genre", "content"]
+
+# Number of valid rows stored per write to the library
+BATCH_SIZE = 10000
+
+# Number of rejected rows described in the import result
+MAX_ERRORS = 100
+
+# Largest CSV field accepted, so a long book body imports like any other (the csv default is 128 KiB);
+# the most a C long holds everywhere, as csv.field_size_limit rejects larger values on some platforms
+MAX_CSV_FIELD = 2 ** 31 - 1
+
+# Supported file formats by extension
+FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl"}
+
+
+# Work out the file format from the file name
+def detect_format(path):
+    for extension, file_format in FORMATS.items():
+        if path.lower().endswith(extension):
+            return file_format
+    raise ValueError(f"Cannot tell the format of {path}; use a .csv or .jsonl file or pass --format")
+
+
+# Read records one at a time from a CSV or JSON Lines file
+def read_records(file, file_format):
+    if file_format == "csv":
+        # Imported only for CSV files, so other commands start faster
+        import csv
+        csv.field_size_limit(MAX_CSV_FIELD)
+        reader = csv.DictReader(file)
+        while True:
+            try:
+                yield next(reader)
+            except StopIteration:
+                return
+            except csv.Error as error:
+                # Let the importer reject this row and carry on with the rest
+                yield error
+    else:
+        for line in file:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # Let the importer reject this row and carry on with the rest
+                    yield None
+
+
+# Check a record with the same rules as the interactive prompts and return (book, error)
+def validate_book(record):
+    if not isinstance(record, dict):
+        return None, "not a valid JSON object"
+    book = {}
+    for field in TEXT_FIELDS:
+        value = str(record.get(field) or "").strip()
+        if not value:
+            return None, f"{field} cannot be blank"
+        book[field] = value
+    # The publication year must be a valid number, like get_valid_year
+    year = str(record.get("year") or "").strip()
+    if not year.isdigit():
+        return None, "publication year must be a valid number"
+    book["year"] = int(year)
+    # Read status may be a JSON boolean or yes/no, true/false, 1/0 text
+    read = record.get("read")
+    book["read"] = read if isinstance(read, bool) else str(read or "").strip().lower() in ("yes", "true", "1")
+    # Keep the ID from the file if there is one, otherwise generate a new one
+    book["id"] = str(record.get("id") or "").strip() or generate_id()
+    # Return the fields in the usual record order
+    return {field: book[field] for field in EXPORT_FIELDS}, None
+
+
+# Import books from a file into the library in large batches
+def import_books(library, file, file_format, batch_size=BATCH_SIZE):
+    start = time.perf_counter()
+    result = {"imported": 0, "rejected": 0, "errors": []}
+    batch = []
+    batch_ids = set()
+    # Data rows start on line 2 of a CSV file, after the header
+    first_row = 2 if file_format == "csv" else 1
+    for row_number, record in enumerate(read_records(file, file_format), first_row):
+        if isinstance(record, Exception):
+            book, error = None, f"unreadable row ({record})"
+        else:
+            book, error = validate_book(record)
+        if book is not None and (book["id"] in library or book["id"] in batch_ids):
+            error = f"a book with ID {book['id']} already exists"
+        if error:
+            result["rejected"] += 1
+            # Keep the first few problems so a bad file does not flood memory
+            if len(result["errors"]) < MAX_ERRORS:
+                result["errors"].append(f"Row {row_number}: {error}")
+            continue
+        batch.append(book)
+        batch_ids.add(book["id"])
+        if len(batch) >= batch_size:
+            # Store the whole batch in one write instead of one save per row
+            library.add_many(batch)
+            result["imported"] += len(batch)
+            batch = []
+            batch_ids = set()
+    if batch:
+        library.add_many(batch)
+        result["imported"] += len(batch)
+    result["seconds"] = time.perf_counter() - start
+    result["rows_per_second"] = (result["imported"] + result["rejected"]) / result["seconds"] if result["seconds"] else 0.0
+    return result
+
+
+# Write books to a CSV or JSON Lines file one at a time
+def export_books(books, file, file_format):
+    start = time.perf_counter()
+    count = 0
+    if file_format == "csv":
+        import csv
+        writer = csv.DictWriter(file, fieldnames=EXPORT_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        for book in books:
+            writer.writerow({**book, "read": "yes" if book["read"] else "no"})
+            count += 1
+    else:
+        for book in books:
+            file.write(json.dumps({field: book[field] for field in EXPORT_FIELDS}) + "\n")
+            count += 1
+    seconds = time.perf_counter() - start
+    return {"exported": count, "seconds": seconds, "rows_per_second": count / seconds if seconds else 0.0}
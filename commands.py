@@ -0,0 +1,74 @@
+from bulk import validate_book  # Import the shared book validation rules
+from library import ConflictError  # Import the edit conflict error
+
+# Book fields a command may set
+EDITABLE_FIELDS = ["title", "author", "year", "genre", "content", "read"]
+
+
+# Check that an optional command field is a whole number of at least minimum (True and False are not numbers here)
+def check_integer(command, field, minimum):
+    value = command.get(field)
+    if value is not None and (isinstance(value, bool) or not isinstance(value, int) or value < minimum):
+        return f"{field} must be a whole number of at least {minimum}"
+    return None
+
+
+# Short form of a book for command results
+def summarize(book):
+    return {field: getattr(book, field) for field in ("id", "title", "author", "year", "genre", "read")}
+
+
+# Run one JSON command against a loaded library and return a JSON-ready result
+# Commands look like {"command": "add", "title": ...}, {"command": "update", "id": ..., "read": true},
+# {"command": "remove", "id": ...}, {"command": "get", "id": ...}, {"command": "search", "query": ...}
+# or {"command": "stats"}
+def run_command(library, command):
+    if not isinstance(command, dict):
+        return {"ok": False, "error": "command must be a JSON object"}
+    name = command.get("command")
+    try:
+        if name == "add":
+            book, error = validate_book(command)
+            if error:
+                return {"ok": False, "error": error}
+            book = library.add(book)
+            return {"ok": True, "id": book.id}
+        if name == "update":
+            existing = library.get(str(command.get("id", "")))
+            if existing is None:
+                return {"ok": False, "error": "book not found"}
+            # Fields that are not given keep their current values
+            book, error = validate_book({**library.full(existing).to_dict(), **{field: command[field] for field in EDITABLE_FIELDS if field in command}})
+            if error:
+                return {"ok": False, "error": error}
+            error = check_integer(command, "version", 1)
+            if error:
+                return {"ok": False, "error": error}
+            # Without an explicit version the edit applies to the book as it is now
+            library.update({**book, "version": command.get("version", existing.version)})
+            return {"ok": True, "id": book["id"]}
+        if name == "remove":
+            if not library.remove(str(command.get("id", ""))):
+                return {"ok": False, "error": "book not found"}
+            return {"ok": True, "id": command["id"]}
+        if name == "get":
+            book = library.get(str(command.get("id", "")))
+            if book is None:
+                return {"ok": False, "error": "book not found"}
+            return {"ok": True, "book": library.full(book).to_dict()}
+        if name == "search":
+            error = check_integer(command, "limit", 1)
+            if error:
+                return {"ok": False, "error": error}
+            if not isinstance(command.get("fuzzy", False), bool):
+                return {"ok": False, "error": "fuzzy must be true or false"}
+            books = library.search(str(command.get("query", "")), command.get("limit"), command.get("fuzzy", False))
+            return {"ok": True, "books": [summarize(book) for book in books]}
+        if name == "stats":
+            return {"ok": True, "stats": library.stats.summary()}
+    except ConflictError as error:
+        return {"ok": False, "error": str(error)}
+    except Exception as error:
+        # Any other failure fails only this command; a batch or shell carries on with the next one
+        return {"ok": False, "error": f"{name} failed: {error}"}
+    return {"ok": False, "error": f"unknown command: {name}"}
@@ -0,0 +1,136 @@
+import os  # Import the os module for random bytes
+import threading  # Import threading to keep IDs monotonic across threads
+import time  # Import time for the timestamp part of the ID
+
+# Crockford base32 alphabet (no I, L, O or U, so IDs are easy to read back)
+ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+# Bits of randomness after the 48-bit millisecond timestamp
+RANDOM_BITS = 80
+
+# Last ID handed out by this process, so IDs within one millisecond keep increasing
+_last_time = 0
+_last_random = 0
+_lock = threading.Lock()
+
+
+# Encode a 128-bit number as 26 base32 characters
+def encode(number):
+    characters = []
+    for _ in range(26):
+        characters.append(ALPHABET[number & 31])
+        number >>= 5
+    return "".join(reversed(characters))
+
+
+# Generate a ULID-style ID: a millisecond timestamp followed by 80 random bits
+def generate_id():
+    global _last_time, _last_random
+    with _lock:
+        now = time.time_ns() // 1_000_000
+        if now <= _last_time:
+            # Same millisecond (or the clock went back): bump the random part so IDs stay unique and sorted
+            now = _last_time
+            _last_random += 1
+            if _last_random >> RANDOM_BITS:
+                # 2^80 IDs in one millisecond will not happen, but never wrap into a duplicate
+                now += 1
+                _last_random = int.from_bytes(os.urandom(10), "big")
+        else:
+            _last_random = int.from_bytes(os.urandom(10), "big")
+        _last_time = now
+        return encode((now << RANDOM_BITS) | _last_random)
+
+
+# Time part (milliseconds) of an ID
+def id_time(book_id):
+    number = 0
+    for character in book_id:
+        number = number * 32 + ALPHABET.index(character)
+    return number >> RANDOM_BITS
+
+
+# Generate IDs with the clock held at fixed millisecond values in turn, as when the system clock is set back
+def with_clock(milliseconds):
+    real_time_ns = time.time_ns
+    try:
+        generated = []
+        for value in milliseconds:
+            time.time_ns = lambda: value * 1_000_000
+            generated.append(generate_id())
+        return generated
+    finally:
+        time.time_ns = real_time_ns
+
+
+# Check the branches a benchmark never reaches; these raise instead of asserting so python -O still runs them
+def run_checks(threads=8, per_thread=20_000):
+    global _last_random
+    # The clock going back must not produce a smaller or repeated ID
+    now = time.time_ns() // 1_000_000 + 10_000
+    generated = with_clock([now, now + 5, now - 1_000, now - 1_000, now + 5])
+    if generated != sorted(generated) or len(set(generated)) != len(generated):
+        raise RuntimeError(f"IDs went backwards or repeated after the clock was set back: {generated}")
+    if id_time(generated[2]) != now + 5:
+        raise RuntimeError("an ID made after the clock was set back does not keep the latest time")
+
+    # A random part that cannot be bumped any further moves on to the next millisecond instead of wrapping
+    with _lock:
+        _last_random = (1 << RANDOM_BITS) - 1
+    before, after = with_clock([now + 5, now + 5])
+    if id_time(after) != now + 6 or after <= before:
+        raise RuntimeError(f"the random part wrapped around instead of moving to the next millisecond: {before} then {after}")
+
+    # Threads share one sequence: no duplicates, and each thread's IDs keep increasing
+    results = [[] for _ in range(threads)]
+
+    def worker(output):
+        for _ in range(per_thread):
+            output.append(generate_id())
+
+    workers = [threading.Thread(target=worker, args=(output,)) for output in results]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    if len({book_id for output in results for book_id in output}) != threads * per_thread:
+        raise RuntimeError("duplicate IDs generated across threads")
+    if any(output != sorted(output) for output in results):
+        raise RuntimeError("IDs from one thread are not increasing")
+
+    # Books saved with the old 3-digit IDs are still found next to new ones
+    import tempfile  # Import tempfile for a throwaway library
+    from library import Library  # Import the library to look books up by ID
+    from storage import open_storage  # Import the storage backends
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "library.json")
+        open_storage(path).save([{"id": "938", "title": "Old book", "author": "Author", "year": 1999, "genre": "Genre", "content": "Old", "read": False, "version": 1}])
+        library = Library(open_storage(path))
+        new_book = library.add({"id": generate_id(), "title": "New book", "author": "Author", "year": 2024, "genre": "Genre", "content": "New", "read": False})
+        old_book = library.get("938")
+        if old_book is None or old_book.title != "Old book" or "938" not in library:
+            raise RuntimeError("a book with an old 3-digit ID cannot be found")
+        if library.get(new_book.id) is None or library.remove("938") is not True or library.get("938") is not None:
+            raise RuntimeError("old and new IDs do not work side by side")
+    print(f"Checked clock rollback, random-part overflow, {threads * per_thread:,} IDs across {threads} threads and old 3-digit IDs")
+
+
+# Generate a batch of IDs and report how fast that is and that none repeat
+if __name__ == "__main__":
+    import argparse  # Import argparse for the benchmark options
+
+    parser = argparse.ArgumentParser(description="Check and benchmark the book ID generator")
+    parser.add_argument("--count", type=int, default=1_000_000, help="Number of IDs to generate")
+    args = parser.parse_args()
+
+    run_checks()
+    start = time.perf_counter()
+    generated = [generate_id() for _ in range(args.count)]
+    elapsed = time.perf_counter() - start
+
+    # Every ID must be unique and IDs from one process must sort in creation order
+    if len(set(generated)) != len(generated):
+        raise RuntimeError("duplicate IDs generated")
+    if generated != sorted(generated):
+        raise RuntimeError("IDs are not monotonic")
+    print(f"Generated {args.count} unique IDs in {elapsed:.2f}s ({args.count / elapsed:,.0f} IDs/sec)")
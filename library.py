@@ -0,0 +1,465 @@
+import contextlib  # Import contextlib to build the transaction context manager
+import functools  # Import functools to keep the names of locked methods
+import itertools  # Import itertools to slice pages out of the results
+import threading  # Import threading for the lock between loading the full-text index and committing a transaction
+import telemetry  # Import the operation timings and counters
+from book import Book, as_book  # Import the compact in-memory book record
+from library_stats import LibraryStats, StatsSnapshot  # Import the running statistics
+from rwlock import ReadWriteLock  # Import the lock shared by readers and writers of one library
+from search_index import LOG_COMPACT_BYTES, SearchIndex, append_log, indexed_fields  # Import the full-text search index and its change log
+
+# Book attributes that get a secondary index
+INDEXED_FIELDS = ["author", "genre", "year", "read"]
+
+# Book attributes the library can be sorted by
+SORT_FIELDS = ["title", "author", "year", "genre"]
+
+
+# Sort key for a book field, ignoring case for text
+def sort_key(book, field):
+    value = getattr(book, field)
+    return value.lower() if isinstance(value, str) else value
+
+
+# Run a method holding the library's read lock, so no writer changes the library halfway through it
+def reads(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock.read:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+# Run a method holding the library's write lock, so no reader sees the library halfway through a change
+def writes(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock.write:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+# Raised when a book was changed by someone else since it was read
+class ConflictError(Exception):
+    pass
+
+
+# In-memory library with a hash index by ID and secondary indexes by attribute
+class Library:
+    def __init__(self, storage, index_path=None):
+        # Remember the storage backend that mutations are written through to
+        self.storage = storage
+        # The full-text index is persisted next to the store unless a path is given
+        self.index_path = index_path or storage.path + ".index"
+        # Operations waiting for the end of a transaction, or None outside one
+        self.pending = None
+        # One library is shared by every Streamlit session thread: reads run together, changes run alone
+        self.lock = ReadWriteLock()
+        # Held while the full-text index is loaded and while a transaction's changes are stored and logged,
+        # the one write that runs without the write lock
+        self.index_lock = threading.Lock()
+        # Set while this process writes to the store, so the changed store is not taken for someone else's change
+        self.storing = False
+        # Load every book and build the indexes
+        self.load()
+
+    # Load every book from storage and build the indexes from scratch
+    @telemetry.timed("library.load")
+    @writes
+    def load(self):
+        # Books keyed by ID; dicts keep insertion order, so iteration follows the file order
+        self.books = {}
+        # For each indexed field, a map from value to the IDs with that value
+        self.indexes = {field: {} for field in INDEXED_FIELDS}
+        # Book IDs in sorted order per field, computed on first use and dropped on change
+        self.sorted_ids = {}
+        # Running totals, kept in step with the indexes
+        self.running_stats = LibraryStats()
+        # Remember the state of the store this process last saw, taken before reading so a write
+        # landing during the read changes the store after this fingerprint and is picked up later
+        self.fingerprint = self.storage.fingerprint()
+        # Load every book once and index it
+        for record in self.storage.load():
+            self.index(Book.from_dict(record))
+        telemetry.count("library.books_loaded", len(self.books))
+        # The full-text index is loaded on first use; writes do not load it, they log their changes next to it
+        self._search_index = None
+        self.search_index_dirty = False
+        # Changes to the full-text index not in its change log yet: those of the write in progress or of an open transaction
+        self.index_changes = []
+        # Fingerprint of the store before the last write, where the log entry for that write starts
+        self.index_log_from = self.fingerprint
+        # Statistics summary and the statistics generation it was computed at
+        self.summary_cache = None
+
+    # Full-text index, reusing the persisted one plus its change log if they reach the store's state and building it otherwise
+    @property
+    def search_index(self):
+        if self._search_index is None:
+            with self.index_lock:
+                if self._search_index is None:
+                    with telemetry.timer("search_index.load"):
+                        search_index = SearchIndex.load(self.index_path, self.fingerprint)
+                    if search_index is None:
+                        # Building needs every book's content, so it only happens when search is used
+                        with telemetry.timer("search_index.build"):
+                            search_index = SearchIndex.build(self.full(book) for book in self)
+                        self.search_index_dirty = True
+                    else:
+                        # Changes of an open transaction are in memory but not in the store or the log yet
+                        search_index.apply_changes(self.index_changes)
+                        # A long log is folded into a new index file the next time the index is saved
+                        self.search_index_dirty = search_index.log_size > LOG_COMPACT_BYTES
+                    self._search_index = search_index
+        return self._search_index
+
+    # The read counts as they are now, with the full summary computed on first use; copying two numbers keeps this O(1)
+    @property
+    @reads
+    def stats(self):
+        return StatsSnapshot(self.running_stats.total, self.running_stats.read, self.summary)
+
+    # Every statistic as plain data, computed once per change to the library and shared by every caller until the next one
+    @reads
+    def summary(self):
+        generation = self.running_stats.generation
+        if self.summary_cache is None or self.summary_cache[0] != generation:
+            self.summary_cache = (generation, self.running_stats.summary())
+        return self.summary_cache[1]
+
+    # Whether the store is unchanged since this process last saw it, or is only being changed by this library itself
+    # The store is read before the flag: a write that ends in between has recorded its fingerprint by then
+    def current(self):
+        return self.storage.fingerprint() == self.fingerprint or self.storing
+
+    # A freshly loaded copy of this library, reusing the open storage backend (and its database connection)
+    def reopen(self):
+        return Library(self.storage, self.index_path)
+
+    # Reload if another process wrote to the store since this process last saw it
+    def refresh(self):
+        if self.storage.fingerprint() != self.fingerprint:
+            self.load()
+
+    # Add a book to the in-memory indexes
+    def index(self, book):
+        self.books[book.id] = book
+        for field in INDEXED_FIELDS:
+            # A dict keyed by ID works as an insertion-ordered set
+            self.indexes[field].setdefault(getattr(book, field), {})[book.id] = None
+        self.running_stats.add(book)
+
+    # Drop a book from the secondary indexes
+    def unindex(self, book):
+        for field in INDEXED_FIELDS:
+            value = getattr(book, field)
+            ids = self.indexes[field][value]
+            del ids[book.id]
+            # Forget values that no book has anymore
+            if not ids:
+                del self.indexes[field][value]
+        self.running_stats.remove(book)
+
+    # Number of books in the library
+    @reads
+    def __len__(self):
+        return len(self.books)
+
+    # Iterate over the books in library order, as they were when iteration started
+    @reads
+    def __iter__(self):
+        return iter(list(self.books.values()))
+
+    # Check whether a book ID exists
+    @reads
+    def __contains__(self, book_id):
+        return book_id in self.books
+
+    # List every book ID in library order
+    @reads
+    def ids(self):
+        return list(self.books)
+
+    # Find a single book by its ID in O(1)
+    @reads
+    def get(self, book_id):
+        return self.books.get(book_id)
+
+    # Read a book's content, which may be kept outside the in-memory record
+    @reads
+    def content(self, book):
+        return book.content if book.content is not None else self.storage.content(book.to_dict())
+
+    # A copy of a book with its content filled in, for editing, export and display
+    @reads
+    def full(self, book):
+        return book if book.content is not None else book.with_changes(content=self.content(book))
+
+    # The book to keep in memory for a stored record: without the content if storage keeps it elsewhere
+    def metadata(self, record):
+        book = Book.from_dict(record)
+        # Inside a transaction the content is not in storage yet, so it stays in memory until commit
+        if self.storage.lazy_content and self.pending is None and book.content is not None:
+            book.content = None
+        return book
+
+    # Find the books matching every given attribute, e.g. find(author="X", read=True)
+    @reads
+    def find(self, **filters):
+        if not filters:
+            # No filters means every book
+            return list(self)
+        # Look up the matching IDs in the secondary index for each field
+        buckets = [self.indexes[field].get(value, {}) for field, value in filters.items()]
+        # Walk the smallest bucket and check the others, so the cost follows the result size
+        buckets.sort(key=len)
+        return [self.books[book_id] for book_id in buckets[0] if all(book_id in bucket for bucket in buckets[1:])]
+
+    # List the distinct values of an indexed field, e.g. for filter dropdowns
+    @reads
+    def values(self, field):
+        return sorted(self.indexes[field], key=lambda value: value.lower() if isinstance(value, str) else value)
+
+    # Iterate over the books matching the filters, optionally sorted by a field
+    # The results are collected under the read lock, so later changes do not disturb the iteration
+    @reads
+    def query(self, sort_by=None, descending=False, **filters):
+        return iter(list(self.ordered(sort_by, descending, filters)))
+
+    # Books matching the filters in order, read lazily; callers hold the read lock while iterating
+    def ordered(self, sort_by, descending, filters):
+        # Drop filters that were left empty
+        filters = {field: value for field, value in filters.items() if value is not None}
+        if sort_by is None:
+            books = self.find(**filters) if filters else list(self)
+            return reversed(books) if descending else iter(books)
+        if filters:
+            # Filtered results are small enough to sort on the spot
+            return iter(sorted(self.find(**filters), key=lambda book: sort_key(book, sort_by), reverse=descending))
+        # Sort the whole library once per field and reuse it until the next change
+        if sort_by not in self.sorted_ids:
+            self.sorted_ids[sort_by] = sorted(self.books, key=lambda book_id: sort_key(self.books[book_id], sort_by))
+        ids = self.sorted_ids[sort_by]
+        return (self.books[book_id] for book_id in (reversed(ids) if descending else ids))
+
+    # Get one page of books and the total number of matches
+    @reads
+    def page(self, offset=0, limit=20, sort_by=None, descending=False, **filters):
+        total = self.count(**filters)
+        books = list(itertools.islice(self.ordered(sort_by, descending, filters), offset, offset + limit))
+        return books, total
+
+    # Count the books matching the filters, straight from the index for a single filter
+    @reads
+    def count(self, **filters):
+        # Drop filters that were left empty
+        filters = {field: value for field, value in filters.items() if value is not None}
+        if not filters:
+            return len(self)
+        if len(filters) == 1:
+            (field, value), = filters.items()
+            return len(self.indexes[field].get(value, {}))
+        return len(self.find(**filters))
+
+    # Search title, author, genre and content, best match first; an exact ID comes first
+    @telemetry.timed("library.search")
+    def search(self, search_term, limit=None, fuzzy=False):
+        return [book for book, score in self.scored_search(search_term, limit, fuzzy)]
+
+    # Search and return (book, score) pairs, so results from several libraries can be merged by score
+    @reads
+    def scored_search(self, search_term, limit=None, fuzzy=False):
+        # An exact ID match outranks every word match
+        results = [(self.books[search_term], float("inf"))] if search_term in self.books else []
+        for book_id, score in self.search_index.search(search_term, limit, fuzzy):
+            if book_id != search_term:
+                results.append((self.books[book_id], score))
+        return results
+
+    # Suggest indexed words that complete a prefix
+    @telemetry.timed("library.suggest")
+    @reads
+    def suggest(self, prefix, limit=10):
+        return self.search_index.suggest(prefix, limit)
+
+    # Write the whole full-text index next to the store if it was built or caught up from a long change log
+    # Holds the store's lock instead of the read lock: no change lands while the index is written, and pages keep reading
+    @telemetry.timed("library.save_index")
+    def save_index(self):
+        if self._search_index is None or not self.search_index_dirty:
+            return
+        with self.storage.lock():
+            if not self.index_changes and self.storage.fingerprint() == self.fingerprint:
+                self._search_index.save(self.index_path, self.fingerprint)
+                self.search_index_dirty = False
+
+    # Record a change to the full-text index: made in memory if the index is loaded, and kept for the change log
+    def index_change(self, operation, book):
+        if self._search_index is not None:
+            if operation == "add":
+                self._search_index.add(book)
+            else:
+                self._search_index.remove(book)
+        self.index_changes.append((operation, indexed_fields(book)))
+
+    # Append the recorded index changes to the change log, as going from the store before the last write to now
+    def log_index_changes(self):
+        if self.index_changes:
+            changes, self.index_changes = self.index_changes, []
+            try:
+                append_log(self.index_path, self.index_log_from, self.fingerprint, changes)
+            except OSError:
+                # The books are saved; without the entry the log no longer reaches the store, so the index is rebuilt
+                pass
+
+    # Record that this process changed the library
+    def changed(self):
+        if self.pending is None:
+            self.log_index_changes()
+        # Sorted orders are stale now
+        self.sorted_ids = {}
+
+    # Write to storage and take the new fingerprint with it, so this process never mistakes its own write for someone else's
+    def store(self, write, *args):
+        before = self.fingerprint
+        self.storing = True
+        try:
+            write(*args)
+            self.fingerprint = self.storage.fingerprint()
+        finally:
+            self.storing = False
+        self.index_log_from = before
+
+    # Send one operation to storage, or hold it until the end of the current transaction
+    def write(self, operation, value):
+        if self.pending is not None:
+            self.pending.append((operation, value))
+        elif operation == "add":
+            self.store(self.storage.add, value)
+        elif operation == "update":
+            self.store(self.storage.update, value)
+        else:
+            self.store(self.storage.remove, value)
+
+    # Group many changes into one write to storage, holding the lock throughout
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.storage.lock():
+            self.refresh()
+            self.pending = []
+            try:
+                yield self
+                operations, self.pending = self.pending, None
+                if operations:
+                    # Each change took the write lock on its own; the durable write runs without it,
+                    # so pages keep reading while the batch is saved
+                    with self.index_lock:
+                        self.store(self.storage.apply, operations)
+                        self.log_index_changes()
+                    with self.lock.write:
+                        self.changed()
+                        # The content is in storage now, so drop it from memory where storage keeps it elsewhere
+                        for operation, value in operations:
+                            if self.storage.lazy_content and operation != "remove" and value["id"] in self.books:
+                                self.books[value["id"]].content = None
+            except BaseException:
+                # Nothing reached storage, so throw away the in-memory changes
+                self.pending = None
+                self.load()
+                raise
+
+    # Add a single book and write it through to storage, returning the stored record
+    @telemetry.timed("library.add")
+    def add(self, book):
+        # Hold the store's lock so concurrent writers queue up instead of overwriting each other, then
+        # the write lock so readers never see half a change (always in this order, or two writers could deadlock)
+        with self.storage.lock(), self.lock.write:
+            # Pick up books other processes added, so this write does not drop them
+            self.refresh()
+            # Every record starts at version 1 and goes up by one on each update
+            book = as_book(book).with_changes(version=1)
+            if book.id in self.books:
+                raise ConflictError(f"A book with ID {book.id} already exists")
+            stored = self.storage.prepare(book.to_dict())
+            self.write("add", stored)
+            self.index(self.metadata(stored))
+            self.index_change("add", book)
+            self.changed()
+        return book
+
+    # Add many books in one write to storage, returning the stored records
+    @telemetry.timed("library.add_many")
+    def add_many(self, books):
+        with self.storage.lock(), self.lock.write:
+            self.refresh()
+            books = [as_book(book).with_changes(version=1) for book in books]
+            # Check every ID first so a batch is either stored whole or not at all
+            seen = set()
+            for book in books:
+                if book.id in self.books or book.id in seen:
+                    raise ConflictError(f"A book with ID {book.id} already exists")
+                seen.add(book.id)
+            stored = [self.storage.prepare(book.to_dict()) for book in books]
+            if self.pending is not None:
+                self.pending.extend(("add", book) for book in stored)
+            else:
+                self.store(self.storage.add_many, stored)
+            for book, record in zip(books, stored):
+                self.index(self.metadata(record))
+                self.index_change("add", book)
+            self.changed()
+        return books
+
+    # Replace a single book with the same ID and write it through to storage
+    # The book must carry the version it was read at; if the stored book moved on since, ConflictError is raised
+    @telemetry.timed("library.update")
+    def update(self, book):
+        with self.storage.lock(), self.lock.write:
+            self.refresh()
+            book = as_book(book)
+            existing = self.books.get(book.id)
+            if existing is None:
+                return False
+            # Compare against the stored record where that is one indexed lookup, so a change the fingerprint missed still counts
+            # (file stores are reread whole by get(); their fingerprint includes the inode and size, so after the refresh
+            # above memory is current, as it is inside a transaction where the lock has been held since the refresh)
+            current = self.storage.get(book.id) if self.pending is None and self.storage.indexed_get else existing.to_dict()
+            if current is None:
+                # Removed elsewhere; pick that up
+                self.load()
+                return False
+            if book.version != current.get("version", 0):
+                raise ConflictError(f"Book {book.id} was changed by someone else; reload it and try again")
+            old_book = self.full(existing)
+            # Edits that leave out the content keep the current one
+            book = book.with_changes(version=current.get("version", 0) + 1, content=old_book.content if book.content is None else book.content, content_ref=None)
+            if book.content == old_book.content and existing.content is None:
+                # Unchanged content that storage keeps elsewhere is not written again
+                stored = book.with_changes(content=None, content_ref=existing.content_ref).to_dict()
+            else:
+                stored = self.storage.prepare(book.to_dict())
+            self.write("update", stored)
+            # Re-index under the new attribute values; the book keeps its place in library order
+            self.unindex(existing)
+            self.index(self.metadata(stored))
+            self.index_change("remove", old_book)
+            self.index_change("add", book)
+            self.changed()
+        return True
+
+    # Remove a single book by its ID and write it through to storage
+    @telemetry.timed("library.remove")
+    def remove(self, book_id):
+        with self.storage.lock(), self.lock.write:
+            self.refresh()
+            existing = self.books.get(book_id)
+            if existing is None:
+                return False
+            # The indexed record includes the content, so read it while it is still stored
+            old_book = self.full(existing)
+            self.write("remove", book_id)
+            self.unindex(existing)
+            del self.books[book_id]
+            self.index_change("remove", old_book)
+            self.changed()
+        return True
@@ -0,0 +1,51 @@
+import threading  # Import threading so sessions on different threads share the cache safely
+from sharding import open_library  # Import the opener for single-file and sharded libraries
+
+# One loaded library per library file, shared by every session in this process
+_libraries = {}
+
+# Guards the cache while a library is looked up or loaded
+_lock = threading.Lock()
+
+# How often the cache was used and how often it had to (re)load from disk
+counters = {"hits": 0, "misses": 0, "invalidations": 0}
+
+
+# Get the shared library for a file, reloading it only if the file changed on disk
+def get_library(path):
+    with _lock:
+        library = _libraries.get(path)
+        # Writes made through the cached library update its fingerprint, so only outside changes miss
+        if library is not None and library.current():
+            counters["hits"] += 1
+            return library
+        if library is not None:
+            # Another process changed the file since it was loaded
+            counters["invalidations"] += 1
+        counters["misses"] += 1
+        # Reuse the open storage backend (and its database connection) when reloading
+        library = library.reopen() if library is not None else open_library(path)
+        _libraries[path] = library
+        return library
+
+
+# The cached library for a file as it is, without loading or reloading it, or None
+def cached_library(path):
+    with _lock:
+        return _libraries.get(path)
+
+
+# Drop a cached library (or all of them) so the next request reloads from disk
+def invalidate(path=None):
+    with _lock:
+        if path is None:
+            _libraries.clear()
+        else:
+            _libraries.pop(path, None)
+        counters["invalidations"] += 1
+
+
+# Snapshot of the hit/miss counters
+def cache_stats():
+    with _lock:
+        return dict(counters)
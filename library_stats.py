@@ -0,0 +1,86 @@
+from collections import Counter  # Import Counter for the per-value tallies
+
+
+# Read and unread counts, shared by the running statistics and snapshots of them
+class ReadCounts:
+    # Number of unread books
+    @property
+    def unread(self):
+        return self.total - self.read
+
+    # Percentage of books that have been read
+    @property
+    def read_percentage(self):
+        return self.read / self.total * 100 if self.total else 0.0
+
+
+# Statistics of a library as a page sees them: the two counts copied when it was taken, and every aggregate from summary()
+class StatsSnapshot(ReadCounts):
+    def __init__(self, total, read, summary):
+        self.total = total
+        self.read = read
+        # Returns the summary as plain data, computed at most once per change to the library
+        self.summary = summary
+
+
+# Running library statistics, kept up to date as books are added, changed and removed
+class LibraryStats(ReadCounts):
+    def __init__(self):
+        # Number of books and number of read books
+        self.total = 0
+        self.read = 0
+        # Number of books per genre, author, decade and publication year
+        self.genres = Counter()
+        self.authors = Counter()
+        self.decades = Counter()
+        self.years = Counter()
+        # Goes up on every change, so a summary computed earlier is known to be out of date
+        self.generation = 0
+
+    # Combine the summaries of several libraries, e.g. the shards of one catalog, into one summary
+    @classmethod
+    def merge_summaries(cls, summaries):
+        stats = cls()
+        for summary in summaries:
+            stats.total += summary["total"]
+            stats.read += summary["read"]
+            stats.genres.update(summary["genres"])
+            stats.authors.update(summary["authors"])
+            # Decades are keyed like "1990s" and years as text in a summary
+            stats.decades.update({int(decade[:-1]): count for decade, count in summary["decades"].items()})
+            stats.years.update({int(year): count for year, count in summary["years"].items()})
+        return stats.summary()
+
+    # Count a book in every aggregate
+    def add(self, book):
+        self.apply(book, 1)
+
+    # Take a book out of every aggregate
+    def remove(self, book):
+        self.apply(book, -1)
+
+    # Add or subtract one book from every aggregate
+    def apply(self, book, change):
+        self.total += change
+        self.read += change if book.read else 0
+        for counter, value in ((self.genres, book.genre), (self.authors, book.author), (self.decades, book.year // 10 * 10), (self.years, book.year)):
+            counter[value] += change
+            # Drop values no book has anymore
+            if counter[value] <= 0:
+                del counter[value]
+        self.generation += 1
+
+    # All aggregates as plain data, ready for printing or JSON output
+    def summary(self):
+        return {
+            "total": self.total,
+            "read": self.read,
+            "unread": self.unread,
+            "read_percentage": round(self.read_percentage, 1),
+            # Most common first
+            "genres": dict(self.genres.most_common()),
+            "authors": dict(self.authors.most_common()),
+            # In chronological order
+            "decades": {f"{decade}s": count for decade, count in sorted(self.decades.items())},
+            "years": {str(year): count for year, count in sorted(self.years.items())},
+        }
@@ -1,39 +1,63 @@
 import streamlit as st  # Import Streamlit for building the web app
-import matplotlib.pyplot as plt  # Import Matplotlib for creating visualizations
-import json  # Import JSON for handling data storage
-import uuid  # Import UUID for generating unique IDs
-
-# File to store library data
-LIBRARY_FILE = "library.json"
-
-# Load library from file
-def load_library():
-    try:
-        # Open the library file in read mode
-        with open(LIBRARY_FILE, "r") as file:
-            # Load the JSON data from the file and convert it to a Python list
-            return json.load(file)
-    except (FileNotFoundError, json.JSONDecodeError):
-        # If the file does not exist or is empty/invalid, return an empty list
-        return []
-
-# Save library to file
-def save_library(library):
-    # Open the library file in write mode
-    with open(LIBRARY_FILE, "w") as file:
-        # Convert the library list to JSON and write it to the file with indentation for readability
-        json.dump(library, file, indent=4)
-
-# Generate a 3-digit unique ID
-def generate_id():
-    # Generate a UUID, convert it to an integer, and take the first 3 digits as the ID
-    return str(uuid.uuid4().int)[:3]
-
-# Load library data
-library = load_library()
-
-# Custom CSS for the book-like UI
-st.markdown("""
+from storage import CorruptLibraryError, default_library_file, list_libraries, named_library_file  # Import the library file lookup
+import io  # Import io to stream uploaded and downloaded files
+import tempfile  # Import tempfile for the export file written before download
+import time  # Import time to measure how long each page takes to render
+import telemetry  # Import the operation timings and counters
+from bulk import FORMATS, detect_format, export_books, import_books  # Import the bulk import/export pipeline
+from book import Book  # Import the compact book record
+from ids import generate_id  # Import the sortable unique ID generator
+from library import SORT_FIELDS  # Import the sort fields
+from background_writer import get_writer  # Import the background writer that saves changes off the page
+from library_cache import cache_stats, get_library  # Import the process-wide library cache
+
+# Entry of the library menu that stands for the default library file
+DEFAULT_LIBRARY = "Default library"
+
+# Choose the library to work on: the default file, a named library, or a new name
+library_name = st.sidebar.selectbox("Library", [DEFAULT_LIBRARY] + list_libraries())  # Libraries in the libraries directory
+new_library_name = st.sidebar.text_input("New library", placeholder="Name of a library to create").strip()  # A new name is created on the first book added
+# File to store library data (a .db/.sqlite path selects the SQLite backend, a .shards manifest a sharded library)
+# Only plain names are accepted here, so nobody can open a file outside the libraries directory from the browser
+try:
+    LIBRARY_FILE = named_library_file(new_library_name or library_name) if new_library_name or library_name != DEFAULT_LIBRARY else default_library_file()
+except ValueError as error:
+    st.sidebar.error(str(error))  # Show why the name was refused
+    st.stop()
+
+# Draw the read/unread pie chart; the image is cached per pair of counts, so reruns reuse it
+@st.cache_data(max_entries=32)
+def read_chart(read_books, unread_books):
+    # Matplotlib is imported on the first chart, so pages without charts do not pay for it
+    import matplotlib
+    matplotlib.use("Agg")  # Render off-screen without probing for a GUI backend
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots()  # Create a Matplotlib figure and axis
+    ax.pie([read_books, unread_books], labels=["Read", "Unread"], autopct='%1.1f%%', colors=['#8B4513', '#F5DEB3'], startangle=90)  # Create a pie chart
+    ax.axis("equal")  # Ensure the pie chart is circular
+    image = io.BytesIO()  # Buffer for the rendered chart
+    fig.savefig(image, format="png")  # Render the chart to PNG
+    plt.close(fig)  # Free the figure
+    return image.getvalue()
+
+# Page sizes offered when displaying all books
+PAGE_SIZES = [10, 25, 50, 100]
+
+# Get the library shared by every session in this process; it is only re-read if the file changed
+try:
+    library = get_library(LIBRARY_FILE)
+except CorruptLibraryError as error:
+    st.error(f"The library could not be opened: {error}")  # Stop before anything is written over the damaged file
+    st.stop()
+
+# Background writer for the library file; pages queue changes and return without waiting for the save
+writer = get_writer(LIBRARY_FILE)
+
+# Identifies this browser session, so failed saves are shown to the session that made the change
+session = st.session_state.setdefault("session_id", generate_id())
+
+# Custom CSS for the book-like UI, sent only with pages that show book cards
+BOOK_CSS = """
     <style>
         .book-cover {
             border: 2px solid #8B4513;  /* Set border color */
@@ -60,19 +84,6 @@ st.markdown("""
             font-size: 18px;  /* Set font size for read status */
             margin-top: 15px;  /* Add margin above the read status */
         }
-        .book-cover .download-button {
-            margin-top: 20px;  /* Add margin above the button */
-            background-color: #8B4513;  /* Set button background color */
-            color: white;  /* Set button text color */
-            border: none;  /* Remove button border */
-            padding: 10px 20px;  /* Add padding inside the button */
-            border-radius: 5px;  /* Round the button corners */
-            cursor: pointer;  /* Change cursor to pointer on hover */
-            font-size: 16px;  /* Set button font size */
-        }
-        .book-cover .download-button:hover {
-            background-color: #A0522D;  /* Change button color on hover */
-        }
         .book-cover::before {
             content: '';  /* Add pseudo-element content */
             position: absolute;  /* Position the pseudo-element absolutely */
@@ -85,12 +96,21 @@ st.markdown("""
             pointer-events: none;  /* Ensure the overlay doesn't block clicks */
         }
     </style>
-""", unsafe_allow_html=True)  # Allow unsafe HTML for custom CSS
+"""
 
 # Streamlit UI
 st.title("📚 Personal Library Manager")  # Set the title of the app
-menu = ["Add a Book", "Remove a Book", "Search for a Book", "Update a Book", "Display All Books", "Statistics"]  # Define menu options
+menu = ["Add a Book", "Remove a Book", "Search for a Book", "Update a Book", "Display All Books", "Statistics", "Import / Export"]  # Define menu options
+if telemetry.enabled or st.query_params.get("diagnostics") == "1":
+    menu.append("Diagnostics")  # Hidden entry, shown when telemetry is on or the URL ends in ?diagnostics=1
 choice = st.sidebar.selectbox("Menu", menu)  # Create a sidebar menu for navigation
+render_start = time.perf_counter()  # When this page started rendering, for telemetry
+cache_counters = cache_stats()  # Get the library cache counters
+st.sidebar.caption(f"Library cache: {cache_counters['hits']} hits, {cache_counters['misses']} loads")  # Show whether reruns reused the loaded library
+if writer.pending():
+    st.sidebar.caption(f"Saving {writer.pending()} changes…")  # Changes queued but not written yet
+for failure in writer.failures(session):
+    st.error(f"A change was not saved: {failure}")  # Report saves that failed since the last page
 
 if choice == "Add a Book":
     st.subheader("➕ Add a New Book")  # Display a subheader for the "Add a Book" section
@@ -105,70 +125,85 @@ if choice == "Add a Book":
         if not title or not author or not genre or not content or not year:
              st.error("All fields are required!")  # Show error if any field is empty
         else:
-            book_id = generate_id()  # Generate a unique 3-digit ID
-            library.append({"id": book_id, "title": title, "author": author, "year": year, "genre": genre, "content": content, "read": read_status})  # Add the book to the library
-            save_library(library)  # Save the updated library to the file
+            book_id = generate_id()  # Generate a unique sortable ID
+            book = Book(book_id, title, author, int(year), genre, read_status, content=content)  # Build the new book record
+            writer.submit(session, "add", book)  # Queue the new book; the writer saves and indexes it in the background
             st.success(f"Book added successfully! ID: {book_id}")  # Show success message
 
 elif choice == "Remove a Book":
     st.subheader("🗑️ Remove a Book")  # Display a subheader for the "Remove a Book" section
-    book_ids = {book['id']: book for book in library}  # Create a dictionary of book IDs and their details
-    book_to_remove = st.selectbox("Select a book ID to remove", list(book_ids.keys()))  # Dropdown to select a book ID to remove
+    book_to_remove = st.selectbox("Select a book ID to remove", library.ids())  # Dropdown to select a book ID to remove
     
     if st.button("Remove Book"):  # Button to remove the book
-        library = [book for book in library if book["id"] != book_to_remove]  # Filter out the book to remove
-        save_library(library)  # Save the updated library to the file
+        writer.submit(session, "remove", book_to_remove)  # Queue the removal; the writer deletes the record and drops it from the indexes
         st.success("Book removed successfully!")  # Show success message
 
 elif choice == "Search for a Book":
     st.subheader("🔍 Search for a Book")  # Display a subheader for the "Search for a Book" section
     search_term = st.text_input("Enter title, author, or ID")  # Input field for the search term
+    fuzzy = st.checkbox("Match words with small typos")  # Checkbox for fuzzy matching
+    if search_term and not search_term.endswith(" "):
+        suggestions = library.suggest(search_term.split()[-1])  # Complete the word being typed
+        if suggestions:
+            st.caption("Suggestions: " + ", ".join(suggestions))  # Show the autocomplete suggestions
     
+    results_shown = st.selectbox("Results to show", PAGE_SIZES)  # Only the best matches are ranked and drawn
     if st.button("Search"):  # Button to search for the book
         if not search_term:
             st.error("Please enter a search term!")  # Show error if the search term is empty
         else:
-            results = [book for book in library if search_term.lower() in book["title"].lower() or search_term.lower() in book["author"].lower() or search_term == book["id"]]  # Search for matching books
-            if results:
-                for book in results:
-                    st.markdown(f"""
-                    <div class="book-cover">
-                        <h4>{book['title']}</h4>
-                        <p><strong>Author:</strong> {book['author']}</p>
-                        <p><strong>Year:</strong> {book['year']}</p>
-                        <p><strong>Genre:</strong> {book['genre']}</p>
-                        <p class="read-status"><strong>Read:</strong> {'✅ Read' if book['read'] else '❌ Unread'}</p>
-                        <p><strong>ID:</strong> {book['id']}</p>
-                        <div>{book['content']}</div>
-                        <a href="data:text/plain;charset=utf-8,{book['content']}" download="{book['title']}.txt">
-                            <button class="download-button">Download</button>
-                        </a>
-                    </div>
-                    """, unsafe_allow_html=True)  # Display the book details with custom CSS
-            else:
-                st.warning("No matching books found!")  # Show warning if no books are found
+            st.session_state.search = (search_term, fuzzy)  # Keep the results on the page while a book's content is opened
+    if st.session_state.get("search") == (search_term, fuzzy):
+        results = library.search(search_term, results_shown, fuzzy)  # The best matches only, best first
+        if results:
+            if len(results) == results_shown:
+                st.caption(f"Showing the {results_shown} best matches. Add words to narrow the search.")
+            st.markdown(BOOK_CSS, unsafe_allow_html=True)  # Style the book cards below
+            for book in results:
+                st.markdown(f"""
+                <div class="book-cover">
+                    <h4>{book.title}</h4>
+                    <p><strong>Author:</strong> {book.author}</p>
+                    <p><strong>Year:</strong> {book.year}</p>
+                    <p><strong>Genre:</strong> {book.genre}</p>
+                    <p class="read-status"><strong>Read:</strong> {'✅ Read' if book.read else '❌ Unread'}</p>
+                    <p><strong>ID:</strong> {book.id}</p>
+                </div>
+                """, unsafe_allow_html=True)  # Display the book details with custom CSS
+                # The content is only read and sent to the browser once the reader asks for it, as in the listing
+                if st.checkbox("Show content", key=f"search-content-{book.id}"):
+                    content = library.content(book)  # Read the content on demand
+                    st.markdown(content)  # Display the book content
+                    st.download_button("Download", content, file_name=f"{book.title}.txt", key=f"search-download-{book.id}")  # Download the content as a text file
+        else:
+            st.warning("No matching books found!")  # Show warning if no books are found
 
 elif choice == "Update a Book":
     st.subheader("✏️ Update a Book")  # Display a subheader for the "Update a Book" section
     book_id = st.text_input("Enter Book ID to update")  # Input field for the book ID to update
-    book = next((book for book in library if book["id"] == book_id), None)  # Find the book by ID
+    book = library.get(book_id)  # Find the book by ID
     
     if book:
-        with st.form("update_form"):  # Create a form for updating the book
-            new_title = st.text_input("Title", book["title"])  # Input field for the new title
-            new_author = st.text_input("Author", book["author"])  # Input field for the new author
-            new_year = st.number_input("Publication Year", min_value=1000, max_value=9999, step=1, value=book["year"])  # Input field for the new publication year
-            new_genre = st.text_input("Genre", book["genre"])  # Input field for the new genre
-            new_content = st.text_area("Book Content (Supports Markdown)", book["content"])  # Text area for the new content
-            new_read_status = st.checkbox("Have you read this book?", book["read"])  # Checkbox for the new read status
+        book = library.full(book)  # Edit a copy with the content filled in
+        version_key = f"update-version-{book_id}"  # Session key for the version this session last saw or saved
+        if book.version > st.session_state.get(version_key, book.version):
+            st.info("This book was changed by someone else since you last saw it; the form shows the saved version.")  # A form showing an older version was replaced
+        st.session_state[version_key] = max(book.version, st.session_state.get(version_key, 0))  # Remember the version shown
+        with st.form(f"update_form-{book.id}-{book.version}"):  # A new form for each version, so an edit is always checked against the version it was made on
+            new_title = st.text_input("Title", book.title)  # Input field for the new title
+            new_author = st.text_input("Author", book.author)  # Input field for the new author
+            new_year = st.number_input("Publication Year", min_value=1000, max_value=9999, step=1, value=book.year)  # Input field for the new publication year
+            new_genre = st.text_input("Genre", book.genre)  # Input field for the new genre
+            new_content = st.text_area("Book Content (Supports Markdown)", book.content)  # Text area for the new content
+            new_read_status = st.checkbox("Have you read this book?", book.read)  # Checkbox for the new read status
             submit_button = st.form_submit_button("Update Book")  # Button to submit the form
             
             if submit_button:
                 if not new_title or not new_author or not new_genre or not new_content:
                     st.error("All fields are required!")  # Show error if any field is empty
                 else:
-                    book.update({"title": new_title, "author": new_author, "year": new_year, "genre": new_genre, "content": new_content, "read": new_read_status})  # Update the book details
-                    save_library(library)  # Save the updated library to the file
+                    st.session_state[version_key] = book.version + 1  # The version this edit saves, so it is not taken for someone else's change
+                    writer.submit(session, "update", book.with_changes(title=new_title, author=new_author, year=new_year, genre=new_genre, content=new_content, read=new_read_status, version=book.version))  # Queue the edit; a conflict with someone else's change is reported on a later page
                     st.success("Book updated successfully!")  # Show success message
     elif book_id:
         st.warning("Book not found!")  # Show warning if the book is not found
@@ -176,38 +211,117 @@ elif choice == "Update a Book":
 elif choice == "Display All Books":
     st.subheader("📖 Your Library")  # Display a subheader for the "Display All Books" section
     if library:
-        for book in library:
+        # Filter, sort and page size controls
+        filter_columns = st.columns(4)
+        author_filter = filter_columns[0].selectbox("Author", ["All"] + library.values("author"))  # Filter by author
+        genre_filter = filter_columns[1].selectbox("Genre", ["All"] + library.values("genre"))  # Filter by genre
+        year_filter = filter_columns[2].selectbox("Year", ["All"] + library.values("year"))  # Filter by publication year
+        read_filter = filter_columns[3].selectbox("Read", ["All", "Read", "Unread"])  # Filter by read status
+        sort_columns = st.columns(3)
+        sort_by = sort_columns[0].selectbox("Sort by", ["Added"] + [field.capitalize() for field in SORT_FIELDS])  # Field to sort by
+        descending = sort_columns[1].checkbox("Descending")  # Sort order
+        page_size = sort_columns[2].selectbox("Books per page", PAGE_SIZES)  # Number of books per page
+
+        # Only the books on the current page are fetched and rendered
+        filters = {
+            "author": None if author_filter == "All" else author_filter,
+            "genre": None if genre_filter == "All" else genre_filter,
+            "year": None if year_filter == "All" else year_filter,
+            "read": None if read_filter == "All" else read_filter == "Read",
+        }
+        total_matches = library.count(**filters)  # Count the matches from the indexes
+        page_count = max(1, -(-total_matches // page_size))  # Round up to whole pages
+        page_number = st.number_input("Page", min_value=1, max_value=page_count, step=1, key=f"page-{filters}-{sort_by}-{descending}-{page_size}")  # Page to show, back to 1 when the view changes
+        books, total_matches = library.page((page_number - 1) * page_size, page_size, None if sort_by == "Added" else sort_by.lower(), descending, **filters)
+        st.caption(f"Showing {len(books)} of {total_matches} books (page {page_number} of {page_count})")  # Show the position in the results
+        st.markdown(BOOK_CSS, unsafe_allow_html=True)  # Style the book cards below
+
+        for book in books:
             st.markdown(f"""
             <div class="book-cover">
-                <h4>{book['title']}</h4>
-                <p><strong>Author:</strong> {book['author']}</p>
-                <p><strong>Year:</strong> {book['year']}</p>
-                <p><strong>Genre:</strong> {book['genre']}</p>
-                <p class="read-status"><strong>Read:</strong> {'✅ Read' if book['read'] else '❌ Unread'}</p>
-                <p><strong>ID:</strong> {book['id']}</p>
-                <div>{book['content']}</div>
-                <a href="data:text/plain;charset=utf-8,{book['content']}" download="{book['title']}.txt">
-                    <button class="download-button">Download</button>
-                </a>
+                <h4>{book.title}</h4>
+                <p><strong>Author:</strong> {book.author}</p>
+                <p><strong>Year:</strong> {book.year}</p>
+                <p><strong>Genre:</strong> {book.genre}</p>
+                <p class="read-status"><strong>Read:</strong> {'✅ Read' if book.read else '❌ Unread'}</p>
+                <p><strong>ID:</strong> {book.id}</p>
             </div>
-            """, unsafe_allow_html=True)  # Display all books with custom CSS
+            """, unsafe_allow_html=True)  # Display the book card with custom CSS
+            # The content is only sent to the browser once the reader asks for it
+            if st.checkbox("Show content", key=f"content-{book.id}"):
+                content = library.content(book)  # Read the content on demand
+                st.markdown(content)  # Display the book content
+                st.download_button("Download", content, file_name=f"{book.title}.txt", key=f"download-{book.id}")  # Download the content as a text file
+        if not books:
+            st.warning("No matching books found!")  # Show warning if nothing matches the filters
     else:
         st.info("Your library is empty!")  # Show info if the library is empty
 
 if choice == "Statistics":
     st.subheader("📊 Library Statistics")  # Display a subheader for the "Statistics" section
-    total_books = len(library)  # Calculate the total number of books
-    read_books = sum(1 for book in library if book["read"])  # Calculate the number of read books
-    unread_books = total_books - read_books  # Calculate the number of unread books
+    stats = library.stats  # Running totals kept up to date on every change
+    total_books = stats.total  # Get the total number of books
+    read_books = stats.read  # Get the number of read books
+    unread_books = stats.unread  # Get the number of unread books
     
     st.write(f"**Total books:** {total_books}")  # Display the total number of books
     st.write(f"**Read books:** {read_books}")  # Display the number of read books
     st.write(f"**Unread books:** {unread_books}")  # Display the number of unread books
     
     if total_books > 0:
-        fig, ax = plt.subplots()  # Create a Matplotlib figure and axis
-        ax.pie([read_books, unread_books], labels=["Read", "Unread"], autopct='%1.1f%%', colors=['#8B4513', '#F5DEB3'], startangle=90)  # Create a pie chart
-        ax.axis("equal")  # Ensure the pie chart is circular
-        st.pyplot(fig)  # Display the pie chart in the app
+        st.image(read_chart(read_books, unread_books))  # Display the pie chart, redrawn only when the counts change
+        summary = stats.summary()  # Get every aggregate
+        st.write("**Books per genre**")
+        st.bar_chart({"Books": summary["genres"]})  # Display the books per genre
+        st.write("**Books per decade**")
+        st.bar_chart({"Books": summary["decades"]})  # Display the books per decade
+        st.write("**Top authors**")
+        st.table({"Author": list(summary["authors"])[:10], "Books": list(summary["authors"].values())[:10]})  # Display the most prolific authors
     else:
-        st.info("No books in the library to display statistics.")  # Show info if the library is empty
\ No newline at end of file
+        st.info("No books in the library to display statistics.")  # Show info if the library is empty
+
+if choice == "Import / Export":
+    st.subheader("📦 Import / Export")  # Display a subheader for the "Import / Export" section
+    uploaded = st.file_uploader("Import books from a CSV or JSON Lines file", type=[extension.lstrip(".") for extension in FORMATS])  # Upload field for the file to import
+    if uploaded is not None and st.button("Import Books"):  # Button to import the uploaded file
+        file = io.TextIOWrapper(uploaded, encoding="utf-8", newline="")  # Read the upload as text without loading it all at once
+        result = import_books(library, file, detect_format(uploaded.name))  # Validate and store the books in large batches
+        st.success(f"Imported {result['imported']} books, rejected {result['rejected']} rows in {result['seconds']:.2f}s ({result['rows_per_second']:,.0f} rows/sec)")  # Show the import summary
+        if result["errors"]:
+            with st.expander("Rejected rows"):
+                st.text("\n".join(result["errors"]))  # Show why rows were rejected
+
+    export_format = st.selectbox("Export format", ["csv", "jsonl"])  # Format for the exported file
+    if st.button("Prepare Export"):  # Button to build the export file
+        with tempfile.TemporaryFile() as export_file:  # Write the export to disk one book at a time instead of building it in memory
+            text = io.TextIOWrapper(export_file, encoding="utf-8", newline="")  # Encode each row as it is written
+            result = export_books((library.full(book).to_dict() for book in library), text, export_format)  # Write every book to the file, content included
+            text.detach()  # Flush the rows and leave the file open for reading
+            export_file.seek(0)
+            # Streamlit keeps a download in memory while it serves it, so the finished file is read once here;
+            # for a library too large for that, use `python app.py export`, which never holds the whole file
+            st.download_button("Download", export_file.read(), file_name=f"library.{export_format}")  # Download the exported file
+        st.caption(f"Exported {result['exported']} books in {result['seconds']:.2f}s ({result['rows_per_second']:,.0f} rows/sec)")  # Show the export summary
+
+if choice == "Diagnostics":
+    st.subheader("🩺 Diagnostics")  # Display a subheader for the "Diagnostics" section
+    telemetry.enable(st.checkbox("Record operation timings", telemetry.enabled))  # Turn telemetry on or off for this server process
+    telemetry.set_slow_threshold(st.number_input("Slow operation threshold (ms)", min_value=1.0, value=telemetry.slow_ms))  # Operations slower than this are logged
+    metrics = telemetry.snapshot()  # Copy of the metrics recorded by this server process
+    rows = telemetry.summarize(metrics)  # Calls, mean, p50, p95 and max per operation, slowest total first
+    if rows:
+        st.write("**Operation timings**")
+        st.table(rows)  # Display the timings
+    else:
+        st.info("No timings recorded yet. Turn on recording above or start the app with LIBRARY_TELEMETRY=1.")  # Explain why the page is empty
+    if metrics["counters"]:
+        st.write("**Counters**")
+        st.table({"Counter": list(metrics["counters"]), "Value": list(metrics["counters"].values())})  # Display the counters
+    if metrics["slow"]:
+        st.write(f"**Slow operations** (over {telemetry.slow_ms:.0f} ms, most recent first)")
+        st.table(list(reversed(metrics["slow"])))  # Display the slow-operation log
+    if st.button("Reset metrics"):  # Button to clear the recorded metrics
+        telemetry.reset()
+        st.rerun()
+
+telemetry.record(f"render.{choice}", time.perf_counter() - render_start)  # Record how long this page took to render
@@ -0,0 +1,97 @@
+import threading  # Import threading for the condition variable and per-thread state
+
+
+# Lock that lets many threads read at once but gives a writer the object to itself
+# Both sides are re-entrant on one thread, and a thread holding the write lock may also read;
+# a thread holding only the read lock may not start writing, since two such threads would wait on each other
+class ReadWriteLock:
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        # Threads holding the read lock, the thread holding the write lock and how often it entered
+        self.readers = 0
+        self.writer = None
+        self.writer_depth = 0
+        # Writers waiting; new readers let them go first so a stream of reads cannot starve a write
+        self.waiting_writers = 0
+        # How often the current thread entered the read lock
+        self.local = threading.local()
+        self.read = ReadSide(self)
+        self.write = WriteSide(self)
+
+    def acquire_read(self):
+        if self.writer == threading.get_ident():
+            # Reading under this thread's own write lock
+            self.writer_depth += 1
+            return
+        depth = getattr(self.local, "depth", 0)
+        if depth == 0:
+            with self.condition:
+                while self.writer is not None or self.waiting_writers:
+                    self.condition.wait()
+                self.readers += 1
+        self.local.depth = depth + 1
+
+    def release_read(self):
+        if self.writer == threading.get_ident():
+            self.writer_depth -= 1
+            return
+        self.local.depth -= 1
+        if self.local.depth == 0:
+            with self.condition:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.condition.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        if self.writer == me:
+            self.writer_depth += 1
+            return
+        if getattr(self.local, "depth", 0):
+            raise RuntimeError("cannot start writing while holding the read lock")
+        with self.condition:
+            self.waiting_writers += 1
+            try:
+                while self.writer is not None or self.readers:
+                    self.condition.wait()
+            finally:
+                self.waiting_writers -= 1
+            self.writer = me
+            self.writer_depth = 1
+
+    def release_write(self):
+        self.writer_depth -= 1
+        if self.writer_depth == 0:
+            with self.condition:
+                self.writer = None
+                self.condition.notify_all()
+
+
+# `with lock.read:` holds the read lock for the block
+class ReadSide:
+    __slots__ = ("lock",)
+
+    def __init__(self, lock):
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire_read()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.lock.release_read()
+
+
+# `with lock.write:` holds the write lock for the block
+class WriteSide:
+    __slots__ = ("lock",)
+
+    def __init__(self, lock):
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire_write()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.lock.release_write()
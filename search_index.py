@@ -0,0 +1,321 @@
+import bisect  # Import bisect for prefix lookups in the sorted vocabulary
+import heapq  # Import heapq to pick the top-ranked results
+import json  # Import the json module to persist the index
+import math  # Import math for the BM25 formula
+import os  # Import the os module to check for and remove index files
+import re  # Import re to split text into words
+import types  # Import types to stand logged books in for real ones
+from storage import write_json_atomic  # Import the atomic JSON file writer
+
+# Searchable book fields and how much a word in each one counts
+FIELD_WEIGHTS = {"title": 3.0, "author": 2.0, "genre": 2.0, "content": 1.0}
+
+# BM25 tuning constants
+K1 = 1.2
+B = 0.75
+
+# Maximum number of vocabulary terms a prefix or fuzzy query expands to
+EXPANSION_LIMIT = 50
+
+# Most books the words a prefix expands to may cover together; the most common match is always kept
+EXPANSION_BOOKS = 5000
+
+# A limited search whose every word is in more books than this walks ranked lists instead of scoring every match
+RANKED_LIST_BOOKS = EXPANSION_BOOKS
+
+# Most ranked lists kept at once; they are dropped whenever the index changes
+RANKED_LIST_CACHE = 64
+
+# Suffix of the log of changes made to the store since the index file was written
+LOG_SUFFIX = ".log"
+
+# Log size in bytes after which loading the index asks for the index file to be written again
+LOG_COMPACT_BYTES = 8 * 1024 * 1024
+
+# Pattern for a single word
+WORD_PATTERN = re.compile(r"\w+")
+
+
+# Split text into lower-case words
+def tokenize(text):
+    return WORD_PATTERN.findall(str(text).lower())
+
+
+# Count the weighted occurrences of each word across the searchable fields of a book
+def term_frequencies(book):
+    frequencies = {}
+    for field, weight in FIELD_WEIGHTS.items():
+        for term in tokenize(getattr(book, field)):
+            frequencies[term] = frequencies.get(term, 0.0) + weight
+    return frequencies
+
+
+# The fields of a book the index reads, as plain data for the change log
+def indexed_fields(book):
+    return {"id": book.id, **{field: getattr(book, field) for field in FIELD_WEIGHTS}}
+
+
+# Log the index changes of one write to the store, going from the store's fingerprint before it to the one after
+# Appending is cheap at any library size; the log is replayed when the index is next loaded
+def append_log(path, before, after, changes):
+    # Without an index file there is nothing to bring up to date; the index is built from the books instead
+    if not os.path.exists(path):
+        return
+    with open(path + LOG_SUFFIX, "a") as file:
+        file.write(json.dumps({"from": before, "to": after, "changes": changes}) + "\n")
+
+
+# Inverted index over title, author, genre and content with BM25 ranking
+class SearchIndex:
+    def __init__(self):
+        # For each word, a map from book ID to its weighted frequency in that book
+        self.postings = {}
+        # Weighted length of every indexed book
+        self.lengths = {}
+        # Sum of all book lengths, for the average length in BM25
+        self.total_length = 0.0
+        # Sorted vocabulary for prefix lookups, rebuilt lazily after changes
+        self.vocabulary = None
+        # For common words, their books ordered by score, best first, built lazily after changes
+        self.ranked_lists = {}
+        # Bytes of change log replayed when the index was loaded
+        self.log_size = 0
+
+    # Build an index for a collection of books
+    @classmethod
+    def build(cls, books):
+        index = cls()
+        for book in books:
+            index.add(book)
+        return index
+
+    # Number of indexed books
+    def __len__(self):
+        return len(self.lengths)
+
+    # Index a single book
+    def add(self, book):
+        frequencies = term_frequencies(book)
+        for term, frequency in frequencies.items():
+            self.postings.setdefault(term, {})[book.id] = frequency
+        length = sum(frequencies.values())
+        self.lengths[book.id] = length
+        self.total_length += length
+        # New words may have appeared, and every score depends on the average length
+        self.vocabulary = None
+        self.ranked_lists = {}
+
+    # Drop a single book, given the record that was indexed
+    def remove(self, book):
+        for term in term_frequencies(book):
+            books = self.postings.get(term)
+            if books is not None:
+                books.pop(book.id, None)
+                # Forget words that no book contains anymore
+                if not books:
+                    del self.postings[term]
+        self.total_length -= self.lengths.pop(book.id, 0.0)
+        self.vocabulary = None
+        self.ranked_lists = {}
+
+    # Re-index a book whose fields changed
+    def update(self, old_book, new_book):
+        self.remove(old_book)
+        self.add(new_book)
+
+    # Get the sorted vocabulary, sorting it only if words were added or removed
+    def sorted_terms(self):
+        if self.vocabulary is None:
+            self.vocabulary = sorted(self.postings)
+        return self.vocabulary
+
+    # List the indexed words starting with a prefix, most common first
+    def suggest(self, prefix, limit=10):
+        prefix = prefix.lower()
+        terms = self.sorted_terms()
+        matches = []
+        # Walk the sorted vocabulary from the first word that could match
+        for position in range(bisect.bisect_left(terms, prefix), len(terms)):
+            if not terms[position].startswith(prefix):
+                break
+            matches.append(terms[position])
+            if len(matches) >= EXPANSION_LIMIT:
+                break
+        # Rank the candidates by how many books contain them
+        return sorted(matches, key=lambda term: -len(self.postings[term]))[:limit]
+
+    # Work out which indexed words a query word stands for
+    def expand(self, term, prefix, fuzzy):
+        if prefix:
+            # The word being typed matches the words it starts, the word itself and the most common first,
+            # but only as many as a bounded number of books contain, so a short prefix does not score half the library
+            matches = self.suggest(term, EXPANSION_LIMIT)
+            if term in self.postings:
+                matches = [term] + [match for match in matches if match != term]
+            terms = []
+            covered = 0
+            for match in matches:
+                size = len(self.postings[match])
+                if terms and covered + size > EXPANSION_BOOKS:
+                    continue
+                terms.append(match)
+                covered += size
+        else:
+            terms = [term] if term in self.postings else []
+        if not terms and fuzzy:
+            # Fall back to the closest spellings in the vocabulary
+            # Imported on first fuzzy search, since most searches never need it
+            import difflib
+            terms = difflib.get_close_matches(term, self.sorted_terms(), n=3, cutoff=0.8)
+        return terms
+
+    # How much a word found frequency times in a book counts, given how rare the word is (idf)
+    def term_score(self, idf, frequency, book_id, average_length):
+        norm = K1 * (1 - B + B * self.lengths[book_id] / average_length)
+        return idf * frequency * (K1 + 1) / (frequency + norm)
+
+    # Rare words count for more than common ones
+    def idf(self, term):
+        total_books = len(self.lengths)
+        size = len(self.postings[term])
+        return math.log(1 + (total_books - size + 0.5) / (size + 0.5))
+
+    # Books containing a word as parallel lists of IDs and scores, best first, sorted once per change to the index
+    def ranked_list(self, term, average_length):
+        ranked = self.ranked_lists.get(term)
+        if ranked is None:
+            books = self.postings[term]
+            idf = self.idf(term)
+            pairs = sorted(((self.term_score(idf, frequency, book_id, average_length), book_id) for book_id, frequency in books.items()), reverse=True)
+            ranked = ([book_id for score, book_id in pairs], [score for score, book_id in pairs])
+            if len(self.ranked_lists) >= RANKED_LIST_CACHE:
+                # Start over rather than tracking use; replacing the dict is safe while other threads read it
+                self.ranked_lists = {}
+            self.ranked_lists[term] = ranked
+        return ranked
+
+    # Top matches of a query made only of common words, each standing for one indexed word
+    # Walks the ranked lists side by side and stops once no unseen book can beat the current top results:
+    # an unseen book scores at most the sum of the scores at the current depth of every list
+    def ranked_search(self, terms, limit, average_length):
+        lists = [self.ranked_list(term, average_length) for term in terms]
+        postings = [self.postings[term] for term in terms]
+        idfs = [self.idf(term) for term in terms]
+        # The best results so far, as a min-heap of (score, book_id)
+        best = []
+        seen = set()
+        for depth in range(min(len(ids) for ids, scores in lists)):
+            bound = 0.0
+            for ids, scores in lists:
+                bound += scores[depth]
+                book_id = ids[depth]
+                if book_id in seen:
+                    continue
+                seen.add(book_id)
+                # Every query word has to match
+                if all(book_id in books for books in postings):
+                    score = sum(self.term_score(idf, books[book_id], book_id, average_length) for idf, books in zip(idfs, postings))
+                    if len(best) < limit:
+                        heapq.heappush(best, (score, book_id))
+                    elif score > best[0][0]:
+                        heapq.heapreplace(best, (score, book_id))
+            if len(best) == limit and best[0][0] >= bound:
+                break
+        # Once the shortest list is used up every book matching all words has been seen
+        return [(book_id, score) for score, book_id in sorted(best, reverse=True)]
+
+    # Search for books matching every query word and return (book_id, score) pairs, best first
+    def search(self, query, limit=None, fuzzy=False):
+        words = tokenize(query)
+        if not words or not self.lengths:
+            return []
+        total_books = len(self.lengths)
+        average_length = self.total_length / total_books
+        # Treat the last word as a prefix so partially typed queries still match
+        expansions = [self.expand(word, position == len(words) - 1, fuzzy) for position, word in enumerate(words)]
+        # Start from the rarest word so the candidate set is small from the outset
+        expansions.sort(key=lambda terms: sum(len(self.postings[term]) for term in terms))
+        if not expansions[0]:
+            return []
+        if limit and all(len(terms) == 1 for terms in expansions) and len(self.postings[expansions[0][0]]) > RANKED_LIST_BOOKS:
+            # Only common words: scoring every book they match would cost time in proportion to the library
+            return self.ranked_search([terms[0] for terms in expansions], limit, average_length)
+        scores = None
+        for terms in expansions:
+            word_scores = {}
+            for term in terms:
+                books = self.postings[term]
+                idf = self.idf(term)
+                # Only score books still in the running, walking whichever side is smaller
+                if scores is None:
+                    candidates = books
+                elif len(books) < len(scores):
+                    candidates = [book_id for book_id in books if book_id in scores]
+                else:
+                    candidates = [book_id for book_id in scores if book_id in books]
+                for book_id in candidates:
+                    word_scores[book_id] = word_scores.get(book_id, 0.0) + self.term_score(idf, books[book_id], book_id, average_length)
+            if scores is None:
+                scores = word_scores
+            else:
+                # Every query word has to match
+                scores = {book_id: scores[book_id] + score for book_id, score in word_scores.items()}
+            if not scores:
+                return []
+        if limit is None:
+            return sorted(scores.items(), key=lambda item: -item[1])
+        return heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+
+    # Apply logged changes, given as (operation, fields) pairs
+    def apply_changes(self, changes):
+        for operation, fields in changes:
+            book = types.SimpleNamespace(**fields)
+            if operation == "add":
+                self.add(book)
+            else:
+                self.remove(book)
+
+    # Write the index to disk together with the fingerprint of the store it matches, and drop the change log it includes
+    # Callers hold the store's lock, so no change is logged in between
+    def save(self, path, fingerprint):
+        # A temp file renamed into place, so a reader never sees a half-written index and two savers never share a file
+        write_json_atomic(path, {"fingerprint": fingerprint, "postings": self.postings, "lengths": self.lengths}, indent=None)
+        try:
+            os.remove(path + LOG_SUFFIX)
+        except FileNotFoundError:
+            pass
+
+    # Read an index from disk and replay the changes logged since, or return None if that does not reach the store's state
+    @classmethod
+    def load(cls, path, fingerprint):
+        try:
+            with open(path, "r") as file:
+                data = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        index = cls()
+        index.postings = data["postings"]
+        index.lengths = data["lengths"]
+        index.total_length = sum(index.lengths.values())
+        state = data.get("fingerprint")
+        try:
+            with open(path + LOG_SUFFIX, "r") as file:
+                for line in file:
+                    if not line.endswith("\n"):
+                        # Torn by a crash; the store was written, so the state check below fails and the index is rebuilt
+                        break
+                    index.log_size += len(line)
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    # Only changes that carry on from the state reached so far apply; earlier ones are already in the file
+                    if entry["from"] == state:
+                        index.apply_changes(entry["changes"])
+                        state = entry["to"]
+        except FileNotFoundError:
+            pass
+        if state != fingerprint:
+            # The store changed in a way the log does not cover
+            return None
+        return index
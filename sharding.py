@@ -0,0 +1,378 @@
+import contextlib  # Import contextlib to build the transaction context manager
+import heapq  # Import heapq to merge sorted and ranked results from the shards
+import itertools  # Import itertools to slice and chain results
+import json  # Import the json module to read and write the shard manifest
+import os  # Import the os module to build file paths and read settings
+import threading  # Import threading to keep each shard's pipe to one caller at a time
+import zlib  # Import zlib for a hash of the book ID that is the same in every process
+from book import as_book  # Import the book record converter
+from library import Library, sort_key  # Import the indexed in-memory library
+from library_stats import LibraryStats, StatsSnapshot  # Import the running statistics
+from storage import load_full, open_storage  # Import the storage backends
+
+# Extension of the manifest file that describes a sharded library
+SHARDS_EXTENSION = ".shards"
+
+# How shards run: "serial" (one after the other), "thread" (a thread per shard) or "process" (a process per shard)
+PARALLEL_MODES = ["serial", "thread", "process"]
+
+
+# Shard a book ID belongs to; crc32 is stable across processes, unlike hash()
+def shard_number(book_id, shard_count):
+    return zlib.crc32(book_id.encode("utf-8")) % shard_count
+
+
+# Whether a path names a sharded library
+def is_sharded(path):
+    return path.lower().endswith(SHARDS_EXTENSION)
+
+
+# Paths of the shard files listed in a manifest, which are relative to the manifest's directory
+def shard_paths(manifest_path):
+    with open(manifest_path, "r") as file:
+        manifest = json.load(file)
+    directory = os.path.dirname(os.path.abspath(manifest_path))
+    return [os.path.join(directory, path) for path in manifest["shards"]]
+
+
+# Split books across a new sharded library by ID hash and return the number of books per shard
+def create_shards(manifest_path, shard_count, extension=".json", books=()):
+    # Shard files live in a directory next to the manifest, so listings only show the manifest
+    directory = os.path.basename(manifest_path) + ".d"
+    os.makedirs(os.path.join(os.path.dirname(os.path.abspath(manifest_path)), directory), exist_ok=True)
+    with open(manifest_path, "w") as file:
+        json.dump({"shards": [os.path.join(directory, f"{number}{extension}") for number in range(shard_count)]}, file, indent=4)
+    return save_books(manifest_path, books)
+
+
+# Replace every shard's books, each book going to the shard its ID hashes to
+def save_books(manifest_path, books):
+    paths = shard_paths(manifest_path)
+    groups = [[] for _ in paths]
+    for book in books:
+        groups[shard_number(book["id"], len(paths))].append(book)
+    for path, group in zip(paths, groups):
+        open_storage(path).save(group)
+    return [len(group) for group in groups]
+
+
+# Read the books of every shard, with their content
+def load_books(manifest_path):
+    return [book for path in shard_paths(manifest_path) for book in load_full(open_storage(path))]
+
+
+# Open a library file: a manifest opens a sharded library, anything else a single-file library
+def open_library(path, parallel=None):
+    # A new named library lives in a directory that may not exist yet
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if is_sharded(path):
+        return ShardedLibrary(path, parallel)
+    return Library(open_storage(path))
+
+
+# Calls that need more than a plain method call on the shard's library
+def shard_window(library, start, stop, sort_by, descending, filters):
+    return list(itertools.islice(library.query(sort_by, descending, **filters), start, stop))
+
+
+def shard_begin(library):
+    # Enter the shard's transaction and keep it open until commit or abort
+    library.open_transaction = library.transaction()
+    library.open_transaction.__enter__()
+
+
+def shard_commit(library):
+    library.open_transaction.__exit__(None, None, None)
+
+
+def shard_abort(library):
+    # Closing with an error throws away the pending changes
+    error = RuntimeError("transaction aborted")
+    library.open_transaction.__exit__(RuntimeError, error, None)
+
+
+SHARD_CALLS = {
+    "books": list,
+    "len": len,
+    "summary": lambda library: library.summary(),
+    "window": shard_window,
+    "begin": shard_begin,
+    "commit": shard_commit,
+    "abort": shard_abort,
+}
+
+
+# Run one call against a shard's library
+def call_shard(library, method, args, kwargs):
+    if method in SHARD_CALLS:
+        return SHARD_CALLS[method](library, *args, **kwargs)
+    return getattr(library, method)(*args, **kwargs)
+
+
+# Result of a call that has already run
+class Done:
+    def __init__(self, function, *args):
+        try:
+            self.value, self.error = function(*args), None
+        except Exception as error:
+            self.value, self.error = None, error
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+# Shard run in the caller's thread, one after the other
+class SerialShard:
+    def __init__(self, path):
+        self.library = Library(open_storage(path))
+
+    def submit(self, method, *args, **kwargs):
+        return Done(call_shard, self.library, method, args, kwargs)
+
+    def close(self):
+        pass
+
+
+# Shard run on its own thread, so every call (and its file lock) stays on one thread
+class ThreadShard:
+    def __init__(self, path):
+        # Imported only for sharded libraries, so single-file startup does not pay for it
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # Load in the background; the first call waits for it
+        self.loaded = self.executor.submit(lambda: Library(open_storage(path)))
+
+    def submit(self, method, *args, **kwargs):
+        return self.executor.submit(lambda: call_shard(self.loaded.result(), method, args, kwargs))
+
+    def close(self):
+        self.executor.shutdown()
+
+
+# Serve calls for one shard in a worker process until the pipe closes
+def serve_shard(path, connection):
+    library = Library(open_storage(path))
+    while True:
+        try:
+            method, args, kwargs = connection.recv()
+        except EOFError:
+            break
+        try:
+            connection.send((call_shard(library, method, args, kwargs), None))
+        except Exception as error:
+            connection.send((None, error))
+
+
+# Shard run in its own process, so searches on different shards use different cores
+class ProcessShard:
+    def __init__(self, path):
+        import multiprocessing
+        # Spawn rather than fork, since the Streamlit server has threads running
+        context = multiprocessing.get_context("spawn")
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=serve_shard, args=(path, child), daemon=True)
+        self.process.start()
+        child.close()
+        # Held from sending a call until its answer is read, so callers on different threads take turns
+        self.lock = threading.Lock()
+
+    def submit(self, method, *args, **kwargs):
+        self.lock.acquire()
+        try:
+            self.connection.send((method, args, kwargs))
+        except BaseException:
+            self.lock.release()
+            raise
+        return PipeResult(self)
+
+    def close(self):
+        self.connection.close()
+        self.process.join(timeout=5)
+
+
+# Answer of a call sent to a shard process, read when asked for
+class PipeResult:
+    def __init__(self, shard):
+        self.shard = shard
+
+    def result(self):
+        try:
+            value, error = self.shard.connection.recv()
+        finally:
+            self.shard.lock.release()
+        if error is not None:
+            raise error
+        return value
+
+
+# One logical library split across several files by ID hash, with reads fanned out to every shard
+class ShardedLibrary:
+    def __init__(self, path, parallel=None):
+        self.path = path
+        # Thread per shard unless LIBRARY_PARALLEL says otherwise
+        self.parallel = parallel or os.environ.get("LIBRARY_PARALLEL", "thread")
+        shard_class = {"serial": SerialShard, "thread": ThreadShard, "process": ProcessShard}[self.parallel]
+        self.shards = [shard_class(shard_path) for shard_path in shard_paths(path)]
+
+    # Run a call on every shard at once and return the results in shard order
+    def fan_out(self, method, *args, **kwargs):
+        # Submitting in shard order keeps callers on different threads from deadlocking on the shard locks
+        pending = [shard.submit(method, *args, **kwargs) for shard in self.shards]
+        return [result.result() for result in pending]
+
+    # Run a call on the shard a book ID belongs to
+    def on_shard(self, book_id, method, *args, **kwargs):
+        return self.shards[shard_number(book_id, len(self.shards))].submit(method, *args, **kwargs).result()
+
+    # Stop the shard threads or processes
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    # Whether no shard changed on disk since it was loaded
+    def current(self):
+        return all(self.fan_out("current"))
+
+    # Pick up changes made elsewhere; the shards reload in place
+    def reopen(self):
+        self.fan_out("refresh")
+        return self
+
+    def refresh(self):
+        self.fan_out("refresh")
+
+    def load(self):
+        self.fan_out("load")
+
+    # Number of books across every shard
+    def __len__(self):
+        return sum(self.fan_out("len"))
+
+    # Iterate over the books shard by shard
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.fan_out("books"))
+
+    def __contains__(self, book_id):
+        return self.on_shard(book_id, "__contains__", book_id)
+
+    def ids(self):
+        return [book_id for ids in self.fan_out("ids") for book_id in ids]
+
+    def get(self, book_id):
+        return self.on_shard(book_id, "get", book_id)
+
+    def content(self, book):
+        return self.on_shard(book.id, "content", book)
+
+    def full(self, book):
+        return self.on_shard(book.id, "full", book)
+
+    def find(self, **filters):
+        return [book for books in self.fan_out("find", **filters) for book in books]
+
+    # Distinct values of an indexed field across every shard
+    def values(self, field):
+        return sorted(set().union(*self.fan_out("values", field)), key=lambda value: value.lower() if isinstance(value, str) else value)
+
+    def count(self, **filters):
+        return sum(self.fan_out("count", **filters))
+
+    # Books matching the filters; sorted results are merged from every shard's sorted list
+    def query(self, sort_by=None, descending=False, **filters):
+        filters = {field: value for field, value in filters.items() if value is not None}
+        return self.merge(self.fan_out("window", 0, None, sort_by, descending, filters), sort_by, descending)
+
+    # Merge per-shard results: by the sort field, or shard after shard in library order
+    @staticmethod
+    def merge(lists, sort_by, descending):
+        if sort_by is None:
+            return itertools.chain.from_iterable(reversed(lists) if descending else lists)
+        return heapq.merge(*lists, key=lambda book: sort_key(book, sort_by), reverse=descending)
+
+    # Get one page of books and the total number of matches, fetching no more than the page needs from each shard
+    def page(self, offset=0, limit=20, sort_by=None, descending=False, **filters):
+        filters = {field: value for field, value in filters.items() if value is not None}
+        counts = self.fan_out("count", **filters)
+        total = sum(counts)
+        if sort_by is not None:
+            # Any book on the page is within the first offset + limit of its own shard
+            lists = self.fan_out("window", 0, offset + limit, sort_by, descending, filters)
+            return list(itertools.islice(self.merge(lists, sort_by, descending), offset, offset + limit)), total
+        # In library order the page covers a run of shards; ask each only for its part
+        order = range(len(self.shards) - 1, -1, -1) if descending else range(len(self.shards))
+        pending = []
+        start, wanted = offset, limit
+        for number in order:
+            if wanted > 0 and start < counts[number]:
+                stop = min(counts[number], start + wanted)
+                pending.append(self.shards[number].submit("window", start, stop, None, descending, filters))
+                wanted -= stop - start
+            start = max(0, start - counts[number])
+        return [book for result in pending for book in result.result()], total
+
+    # Search every shard at once and merge the rankings by score
+    def search(self, search_term, limit=None, fuzzy=False):
+        return [book for book, score in self.scored_search(search_term, limit, fuzzy)]
+
+    def scored_search(self, search_term, limit=None, fuzzy=False):
+        results = itertools.chain.from_iterable(self.fan_out("scored_search", search_term, limit, fuzzy))
+        if limit is None:
+            return sorted(results, key=lambda item: -item[1])
+        return heapq.nlargest(limit, results, key=lambda item: item[1])
+
+    # Suggest words from every shard, preferring words suggested by more shards and ranked higher
+    def suggest(self, prefix, limit=10):
+        ranks = {}
+        for words in self.fan_out("suggest", prefix, limit):
+            for rank, word in enumerate(words):
+                shards, best = ranks.get(word, (0, rank))
+                ranks[word] = (shards + 1, min(best, rank))
+        return sorted(ranks, key=lambda word: (-ranks[word][0], ranks[word][1], word))[:limit]
+
+    # Statistics of every shard added together; each shard caches its summary, so this costs one merge of them
+    def summary(self):
+        return LibraryStats.merge_summaries(self.fan_out("summary"))
+
+    @property
+    def stats(self):
+        summary = self.summary()
+        return StatsSnapshot(summary["total"], summary["read"], lambda: summary)
+
+    def save_index(self):
+        self.fan_out("save_index")
+
+    # Changes go to the shard each book belongs to
+    def add(self, book):
+        book = as_book(book)
+        return self.on_shard(book.id, "add", book)
+
+    # Add many books, one batch per shard, written in parallel
+    def add_many(self, books):
+        groups = [[] for _ in self.shards]
+        for book in books:
+            book = as_book(book)
+            groups[shard_number(book.id, len(self.shards))].append(book)
+        pending = [shard.submit("add_many", group) for shard, group in zip(self.shards, groups) if group]
+        return [book for result in pending for book in result.result()]
+
+    def update(self, book):
+        book = as_book(book)
+        return self.on_shard(book.id, "update", book)
+
+    def remove(self, book_id):
+        return self.on_shard(book_id, "remove", book_id)
+
+    # Group many changes into one write per shard; each shard commits on its own
+    @contextlib.contextmanager
+    def transaction(self):
+        self.fan_out("begin")
+        try:
+            yield self
+        except BaseException:
+            self.fan_out("abort")
+            raise
+        self.fan_out("commit")
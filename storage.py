@@ -0,0 +1,637 @@
+import json  # Import the json module to work with JSON data
+import os  # Import the os module to read environment variables
+import zlib  # Import zlib for optional content compression in SQLite
+import threading  # Import threading so threads in one process share a file lock
+import telemetry  # Import the operation timings and counters
+from blobs import BlobStore  # Import the separate store for book bodies
+
+try:
+    import fcntl  # Import fcntl for advisory file locks on Unix
+except ImportError:
+    fcntl = None
+    import msvcrt  # Import msvcrt for file locks on Windows
+
+# Book fields in the order they are stored
+BOOK_FIELDS = ["id", "title", "author", "year", "genre", "content", "read", "version"]
+
+# Book fields without the (possibly large) content
+META_FIELDS = [field for field in BOOK_FIELDS if field != "content"]
+
+# File extensions that select the SQLite backend
+SQLITE_EXTENSIONS = (".db", ".sqlite", ".sqlite3")
+
+# Journal size in bytes after which the JSON store is compacted automatically
+JOURNAL_COMPACT_BYTES = 1024 * 1024
+
+
+# Raised when a library file exists but cannot be read, so it is never mistaken for an empty library
+class CorruptLibraryError(Exception):
+    pass
+
+
+# Inode, size and modification time of a file, or zeros if it does not exist
+def file_fingerprint(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return [0, 0, 0]
+    # Atomic rewrites create a new inode, which catches rewrites within one mtime tick
+    return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+
+# Advisory lock on a library file, shared by every process and thread that writes to it
+class FileLock:
+    def __init__(self, path):
+        # The lock is taken on a separate file so the library file itself can be replaced
+        self.path = path + ".lock"
+        # Threads in this process queue up here; the same thread may re-enter
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.file = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        if self.depth == 0:
+            # First entry in this process: take the lock that other processes see
+            self.file = open(self.path, "a")
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+            else:
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0:
+            # Last exit in this process: let other processes in
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            else:
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+            self.file.close()
+            self.file = None
+        self.thread_lock.release()
+
+
+# One lock object per library file in this process
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+# Get the lock for a library file
+def file_lock(path):
+    with _locks_guard:
+        key = os.path.abspath(path)
+        if key not in _locks:
+            _locks[key] = FileLock(key)
+        return _locks[key]
+
+
+# Write a JSON document to a file atomically with a temp file and rename
+def write_json_atomic(path, data, indent=4):
+    # Imported on the first write, so read-only commands start faster
+    import tempfile
+    # Create the temp file next to the target so the rename stays on one filesystem
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".library-", suffix=".tmp")
+    try:
+        # Keep the permissions of the file being replaced (mkstemp creates it owner-only)
+        try:
+            os.fchmod(fd, os.stat(path).st_mode & 0o777)
+        except FileNotFoundError:
+            os.fchmod(fd, 0o644)
+        with os.fdopen(fd, "w") as file:
+            # Convert the data to JSON, indented for readability unless the caller asks for compact output
+            json.dump(data, file, indent=indent)
+            # Make sure the data is on disk before it replaces the old file
+            file.flush()
+            os.fsync(file.fileno())
+            # Size of every full rewrite, to see how much each save costs
+            telemetry.count("json.bytes_written", file.tell())
+        # Swap the new file in; readers see either the old or the new file, never a partial one
+        os.replace(temp_path, path)
+    except BaseException:
+        # Clean up the temp file if anything went wrong
+        os.unlink(temp_path)
+        raise
+
+
+# Storage backend that keeps the whole library in a single JSON file
+class JsonStorage:
+    # get() reads the whole file, so callers should not use it on a hot path
+    indexed_get = False
+
+    def __init__(self, path, lazy_content=False, compress=False):
+        # Remember the path of the JSON file
+        self.path = path
+        # With lazy content, book bodies live in a separate file and records only hold a reference
+        self.lazy_content = lazy_content
+        # The content file is always available so references written earlier can be read
+        self.blobs = BlobStore(path + ".content", compress)
+
+    # Load every book from the JSON file
+    @telemetry.timed("json.load")
+    def load(self):
+        try:
+            # Open the library file in read mode
+            with open(self.path, "r") as file:
+                text = file.read()
+        except FileNotFoundError:
+            # No file yet means an empty library
+            return []
+        try:
+            # Convert the JSON data to a Python list
+            library = json.loads(text)
+        except json.JSONDecodeError as error:
+            # Never treat a damaged file as empty: the next save would overwrite every book in it
+            raise CorruptLibraryError(f"{self.path} is not valid JSON ({error}); fix or restore it before making changes") from None
+        if not isinstance(library, list):
+            raise CorruptLibraryError(f"{self.path} does not hold a list of books; fix or restore it before making changes")
+        # These records may point into a content file written by a compaction since the last load
+        self.blobs.reset()
+        return library
+
+    # Save every book to the JSON file
+    @telemetry.timed("json.save")
+    def save(self, library):
+        # Move any inline content out to the content file first
+        library = [self.prepare(book) for book in library]
+        # The bodies must be on disk before records pointing at them
+        self.blobs.sync()
+        # Write to a temp file and rename it so a crash never leaves a truncated library
+        write_json_atomic(self.path, library)
+
+    # Turn a book into the record to store, moving its content to the content file in lazy mode
+    def prepare(self, book):
+        if not self.lazy_content or "content" not in book:
+            return book
+        record = {field: value for field, value in book.items() if field != "content"}
+        record["content_ref"] = self.blobs.put(book["content"])
+        return record
+
+    # Rewrite the library in one snapshot; with content=True the bodies still in use are also copied to a new content file
+    # and the old content files, with every body that was replaced or removed, are deleted
+    # Only for callers that reload afterwards: books already in memory hold positions in the old content file
+    @telemetry.timed("json.compact")
+    def compact(self, content=True):
+        books = self.load()
+        if content and self.blobs.generations():
+            books = self.blobs.rewrite(books)
+            # The records must point at the new file before the old one goes
+            self.save(books)
+            self.blobs.remove_old()
+        else:
+            self.save(books)
+
+    # Read a book's content, wherever it is kept
+    @telemetry.timed("json.content")
+    def content(self, book):
+        return book["content"] if "content" in book else self.blobs.get(book["content_ref"])
+
+    # Fingerprint of the file, used to notice changes made elsewhere
+    def fingerprint(self):
+        return file_fingerprint(self.path)
+
+    # Lock to hold around a read-modify-write of the library
+    def lock(self):
+        return file_lock(self.path)
+
+    # Find a single book by its ID
+    @telemetry.timed("json.get")
+    def get(self, book_id):
+        # A flat file has no index, so scan the list for the ID
+        return next((book for book in self.load() if book["id"] == book_id), None)
+
+    # Add a single book
+    @telemetry.timed("json.add")
+    def add(self, book):
+        # Load the library, append the book and write it back
+        library = self.load()
+        library.append(self.prepare(book))
+        self.save(library)
+
+    # Add many books with a single rewrite of the file
+    @telemetry.timed("json.add_many")
+    def add_many(self, books):
+        library = self.load()
+        library.extend(self.prepare(book) for book in books)
+        self.save(library)
+
+    # Apply a list of ("add", book), ("update", book) and ("remove", book_id) operations with one rewrite
+    @telemetry.timed("json.apply")
+    def apply(self, operations):
+        # Key the books by ID so each operation is O(1); dicts keep the file order
+        books = {book["id"]: book for book in self.load()}
+        for operation, value in operations:
+            if operation == "remove":
+                books.pop(value, None)
+            else:
+                books[value["id"]] = self.prepare(value)
+        self.save(list(books.values()))
+
+    # Replace a single book that has the same ID
+    @telemetry.timed("json.update")
+    def update(self, book):
+        # Load the library and swap in the new record
+        library = self.load()
+        for index, existing in enumerate(library):
+            if existing["id"] == book["id"]:
+                library[index] = self.prepare(book)
+                self.save(library)
+                return True
+        # Return False if no book had that ID
+        return False
+
+    # Remove a single book by its ID
+    @telemetry.timed("json.remove")
+    def remove(self, book_id):
+        # Load the library and filter out the book with the given ID
+        library = self.load()
+        remaining = [book for book in library if book["id"] != book_id]
+        # Only write the file back if a book was actually removed
+        if len(remaining) < len(library):
+            self.save(remaining)
+            return True
+        return False
+
+
+# JSON storage that appends each change to a write-ahead journal instead of rewriting the file
+class JournalStorage(JsonStorage):
+    def __init__(self, path, lazy_content=False, compress=False, compact_bytes=JOURNAL_COMPACT_BYTES):
+        super().__init__(path, lazy_content, compress)
+        # The journal lives next to the snapshot as one JSON record per line
+        self.journal_path = path + ".journal"
+        # Compact once the journal grows past this many bytes
+        self.compact_bytes = compact_bytes
+
+    # Read the journal records, ignoring a partially written last line
+    def read_journal(self):
+        records = []
+        try:
+            with open(self.journal_path, "r") as file:
+                for number, line in enumerate(file, 1):
+                    if not line.endswith("\n"):
+                        # A crash during an append can leave a torn final record without its newline; skip it
+                        break
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError as error:
+                        # A complete line that does not parse is damage, not a torn append
+                        raise CorruptLibraryError(f"{self.journal_path} line {number} is not valid JSON: {error}") from None
+        except FileNotFoundError:
+            # No journal yet means no changes since the last snapshot
+            pass
+        return records
+
+    # Cut a torn final record off the journal, so the next append starts on a line of its own
+    def trim_journal(self):
+        try:
+            file = open(self.journal_path, "r+b")
+        except FileNotFoundError:
+            return
+        with file:
+            end = file.seek(0, os.SEEK_END)
+            position = end
+            # Walk back from the end to the last newline, a block at a time
+            while position > 0:
+                start = max(0, position - 4096)
+                file.seek(start)
+                block = file.read(position - start)
+                newline = block.rfind(b"\n")
+                if newline != -1:
+                    position = start + newline + 1
+                    break
+                position = start
+            if position < end:
+                file.truncate(position)
+                file.flush()
+                os.fsync(file.fileno())
+
+    # Rebuild the library from the last snapshot plus the journal
+    @telemetry.timed("journal.load")
+    def load(self):
+        # Keep the books keyed by ID so replaying each record is O(1)
+        books = {book["id"]: book for book in super().load()}
+        for record in self.read_journal():
+            if record["op"] == "remove":
+                books.pop(record["id"], None)
+            else:
+                # "add" and "update" both store the full record
+                books[record["book"]["id"]] = record["book"]
+        return list(books.values())
+
+    # Fingerprint of both the snapshot and the journal
+    def fingerprint(self):
+        return file_fingerprint(self.path) + file_fingerprint(self.journal_path)
+
+    # Append one record to the journal and flush it to disk
+    def append(self, record):
+        self.append_many([record])
+
+    # Append several records to the journal with a single flush to disk
+    def append_many(self, records):
+        records = list(records)
+        # The bodies must be on disk before journal records pointing at them
+        self.blobs.sync()
+        # Callers hold the library lock, so nobody else is appending while a torn record is cut off
+        self.trim_journal()
+        with open(self.journal_path, "a") as file:
+            # Where this append starts, to count the bytes it adds
+            start = file.tell()
+            file.writelines(json.dumps(record) + "\n" for record in records)
+            file.flush()
+            os.fsync(file.fileno())
+            telemetry.count("journal.bytes_written", file.tell() - start)
+        # Fold the journal into a new snapshot once it gets too big
+        if os.path.getsize(self.journal_path) >= self.compact_bytes:
+            self.compact()
+
+    # Write a new snapshot atomically and start an empty journal; the automatic compaction above leaves the content file
+    # alone, since the library doing the write keeps its books' positions in it
+    @telemetry.timed("journal.compact")
+    def compact(self, content=False):
+        super().compact(content)
+
+    # Replace the whole library with a fresh snapshot
+    @telemetry.timed("journal.save")
+    def save(self, library):
+        # The snapshot must be durable before the journal it replaces is dropped
+        super().save(library)
+        try:
+            os.remove(self.journal_path)
+        except FileNotFoundError:
+            pass
+
+    # Add a single book
+    @telemetry.timed("journal.add")
+    def add(self, book):
+        self.append({"op": "add", "book": self.prepare(book)})
+
+    # Add many books with one journal write
+    @telemetry.timed("journal.add_many")
+    def add_many(self, books):
+        self.append_many({"op": "add", "book": self.prepare(book)} for book in books)
+
+    # Apply a list of operations with one journal write
+    @telemetry.timed("journal.apply")
+    def apply(self, operations):
+        self.append_many({"op": "remove", "id": value} if operation == "remove" else {"op": operation, "book": self.prepare(value)} for operation, value in operations)
+
+    # Replace a single book that has the same ID
+    # The caller has already checked that the book exists, so this is one append with no reread of the library
+    @telemetry.timed("journal.update")
+    def update(self, book):
+        self.append({"op": "update", "book": self.prepare(book)})
+        return True
+
+    # Remove a single book by its ID, which the caller has already checked exists
+    @telemetry.timed("journal.remove")
+    def remove(self, book_id):
+        self.append({"op": "remove", "id": book_id})
+        return True
+
+
+# Storage backend that keeps one indexed row per book in a SQLite database
+class SqliteStorage:
+    # Content stays in its own column and is only selected when asked for
+    lazy_content = True
+
+    # get() is one primary-key lookup
+    indexed_get = True
+
+    def __init__(self, path, compress=False):
+        # Remember the path of the database file
+        self.path = path
+        # Store new content zlib-compressed when asked
+        self.compress = compress
+        # Imported only when a SQLite library is opened
+        import sqlite3
+        # Open the database (Streamlit reruns can land on different threads, so allow sharing it)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # One thread at a time on the connection, since a read on another thread during a commit fails
+        self.connection_lock = threading.RLock()
+        # Make sure the schema exists
+        self.create_schema()
+
+    # Create the books table and its indexes if they do not exist yet
+    def create_schema(self):
+        with self.connection_lock, self.connection:
+            # The primary key gives an index on id
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS books (
+                    id TEXT PRIMARY KEY,
+                    title TEXT NOT NULL,
+                    author TEXT NOT NULL,
+                    year INTEGER NOT NULL,
+                    genre TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    read INTEGER NOT NULL,
+                    version INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            # Databases created before books had versions need the column added
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(books)")]
+            if "version" not in columns:
+                self.connection.execute("ALTER TABLE books ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            # Secondary indexes for the attributes the app filters on
+            self.connection.execute("CREATE INDEX IF NOT EXISTS books_author ON books (author)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS books_genre ON books (genre)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS books_year ON books (year)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS books_read ON books (read)")
+
+    # Convert a metadata row back into the JSON book shape, without content
+    @staticmethod
+    def row_to_book(row):
+        book = dict(zip(META_FIELDS, row))
+        # SQLite stores booleans as 0/1
+        book["read"] = bool(book["read"])
+        return book
+
+    # Convert a book into a tuple of column values
+    def book_to_row(self, book):
+        content = zlib.compress(book["content"].encode("utf-8")) if self.compress else book["content"]
+        return (book["id"], book["title"], book["author"], book["year"], book["genre"], content, int(book["read"]), book.get("version", 0))
+
+    # Build the UPDATE for a book, leaving the content column alone if the book carries no content
+    def update_statement(self, book):
+        if "content" in book:
+            return "UPDATE books SET title = ?, author = ?, year = ?, genre = ?, content = ?, read = ?, version = ? WHERE id = ?", self.book_to_row(book)[1:] + (book["id"],)
+        return "UPDATE books SET title = ?, author = ?, year = ?, genre = ?, read = ?, version = ? WHERE id = ?", (book["title"], book["author"], book["year"], book["genre"], int(book["read"]), book.get("version", 0), book["id"])
+
+    # Records are stored as given; content goes in its own column
+    def prepare(self, book):
+        return book
+
+    # Read a book's content on demand
+    @telemetry.timed("sqlite.content")
+    def content(self, book):
+        if "content" in book:
+            return book["content"]
+        with self.connection_lock:
+            row = self.connection.execute("SELECT content FROM books WHERE id = ?", (book["id"],)).fetchone()
+        if row is None:
+            return None
+        # Compressed content comes back as bytes
+        return zlib.decompress(row[0]).decode("utf-8") if isinstance(row[0], bytes) else row[0]
+
+    # Fingerprint of the database file
+    def fingerprint(self):
+        return file_fingerprint(self.path)
+
+    # Lock to hold around a read-modify-write of the library
+    def lock(self):
+        return file_lock(self.path)
+
+    # Load every book's metadata from the database
+    @telemetry.timed("sqlite.load")
+    def load(self):
+        with self.connection_lock:
+            rows = self.connection.execute(f"SELECT {', '.join(META_FIELDS)} FROM books ORDER BY rowid")
+            return [self.row_to_book(row) for row in rows]
+
+    # Replace the whole library in a single transaction
+    @telemetry.timed("sqlite.save")
+    def save(self, library):
+        with self.connection_lock, self.connection:
+            self.connection.execute("DELETE FROM books")
+            self.connection.executemany("INSERT INTO books VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (self.book_to_row(book) for book in library))
+
+    # Find a single book by its ID using the primary key index
+    @telemetry.timed("sqlite.get")
+    def get(self, book_id):
+        with self.connection_lock:
+            row = self.connection.execute(f"SELECT {', '.join(META_FIELDS)} FROM books WHERE id = ?", (book_id,)).fetchone()
+        return self.row_to_book(row) if row else None
+
+    # Add a single book
+    @telemetry.timed("sqlite.add")
+    def add(self, book):
+        with self.connection_lock, self.connection:
+            self.connection.execute("INSERT INTO books VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self.book_to_row(book))
+
+    # Add many books in a single transaction
+    @telemetry.timed("sqlite.add_many")
+    def add_many(self, books):
+        with self.connection_lock, self.connection:
+            self.connection.executemany("INSERT INTO books VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (self.book_to_row(book) for book in books))
+
+    # Apply a list of operations in a single transaction
+    @telemetry.timed("sqlite.apply")
+    def apply(self, operations):
+        with self.connection_lock, self.connection:
+            for operation, value in operations:
+                if operation == "add":
+                    self.connection.execute("INSERT INTO books VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self.book_to_row(value))
+                elif operation == "update":
+                    self.connection.execute(*self.update_statement(value))
+                else:
+                    self.connection.execute("DELETE FROM books WHERE id = ?", (value,))
+
+    # Replace a single book that has the same ID
+    @telemetry.timed("sqlite.update")
+    def update(self, book):
+        with self.connection_lock, self.connection:
+            cursor = self.connection.execute(*self.update_statement(book))
+        # Return whether a row was actually changed
+        return cursor.rowcount > 0
+
+    # Remove a single book by its ID
+    @telemetry.timed("sqlite.remove")
+    def remove(self, book_id):
+        with self.connection_lock, self.connection:
+            cursor = self.connection.execute("DELETE FROM books WHERE id = ?", (book_id,))
+        # Return whether a row was actually deleted
+        return cursor.rowcount > 0
+
+    # Close the database connection
+    def close(self):
+        self.connection.close()
+
+
+# Pick the storage backend from the file extension
+def open_storage(path, journal=None, lazy_content=None, compress=None):
+    # Content compression is on when requested or when LIBRARY_COMPRESS=1 is set
+    if compress is None:
+        compress = os.environ.get("LIBRARY_COMPRESS") == "1"
+    if path.lower().endswith(SQLITE_EXTENSIONS):
+        # Use SQLite for .db/.sqlite/.sqlite3 files
+        return SqliteStorage(path, compress)
+    # Journal mode is on when requested or when LIBRARY_JOURNAL=1 is set
+    if journal is None:
+        journal = os.environ.get("LIBRARY_JOURNAL") == "1"
+    # Keeping content in a separate file is on when requested or when LIBRARY_LAZY_CONTENT=1 is set
+    if lazy_content is None:
+        lazy_content = os.environ.get("LIBRARY_LAZY_CONTENT") == "1"
+    if journal:
+        # Append changes to a journal next to the JSON snapshot
+        return JournalStorage(path, lazy_content, compress)
+    # Fall back to the plain JSON file
+    return JsonStorage(path, lazy_content, compress)
+
+
+# Load every book including its content, for callers that need complete records
+def load_full(storage):
+    return [book if "content" in book else {**book, "content": storage.content(book)} for book in storage.load()]
+
+
+# Copy every book from a JSON library file into a SQLite database
+def migrate_json_to_sqlite(json_path, sqlite_path):
+    # Read the existing JSON library, fetching any content kept in the content file
+    library = load_full(JsonStorage(json_path))
+    # Write it into the database in one transaction
+    database = SqliteStorage(sqlite_path)
+    database.save(library)
+    database.close()
+    # Return the number of books migrated
+    return len(library)
+
+
+# Default library location, overridable through the LIBRARY_FILE environment variable
+def default_library_file():
+    return os.environ.get("LIBRARY_FILE", "library.json")
+
+
+# File extensions of library files, including the manifest of a sharded library
+LIBRARY_EXTENSIONS = (".json",) + SQLITE_EXTENSIONS + (".shards",)
+
+
+# Directory holding named libraries (LIBRARY_DIR, default "libraries")
+def libraries_directory():
+    return os.environ.get("LIBRARY_DIR", "libraries")
+
+
+# Library file for a name from the CLI's --library; anything with a path separator is used as a path
+def library_file(name=None):
+    if not name:
+        return default_library_file()
+    if os.sep in name or (os.altsep and os.altsep in name):
+        return name
+    return named_library_file(name)
+
+
+# Library file for a plain name, which always stays inside the libraries directory
+# (the web app only accepts these, so a browser cannot point the server at another file)
+def named_library_file(name):
+    if not name or name.startswith(".") or "\0" in name or os.sep in name or (os.altsep and os.altsep in name):
+        raise ValueError(f"Library names cannot contain path separators or start with a dot: {name!r}")
+    # Names are files in the libraries directory, as given if they carry an extension
+    if name.lower().endswith(LIBRARY_EXTENSIONS):
+        return os.path.join(libraries_directory(), name)
+    # Otherwise the existing library of that name, JSON first, so a sharded or SQLite library opens by its bare name too;
+    # a new library is JSON
+    for extension in LIBRARY_EXTENSIONS:
+        path = os.path.join(libraries_directory(), name + extension)
+        if os.path.exists(path):
+            return path
+    return os.path.join(libraries_directory(), name + ".json")
+
+
+# Names of the libraries in the libraries directory
+def list_libraries():
+    try:
+        files = os.listdir(libraries_directory())
+    except FileNotFoundError:
+        return []
+    # JSON libraries are listed without their extension, like they are selected
+    return sorted(name[:-len(".json")] if name.endswith(".json") else name for name in files if name.lower().endswith(LIBRARY_EXTENSIONS))
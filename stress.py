@@ -0,0 +1,128 @@
+import argparse  # Import argparse for the stress test options
+import multiprocessing  # Import multiprocessing to run writers in parallel
+import os  # Import the os module to build file paths
+import tempfile  # Import tempfile for a throwaway library
+import threading  # Import threading for the shared-library readers
+import time  # Import time to measure throughput
+from book import Book  # Import the compact book record
+from ids import generate_id  # Import the book ID generator
+from library import ConflictError, Library  # Import the library and its conflict error
+from storage import open_storage  # Import the storage backends
+
+# ID of the book every worker updates, used as a shared counter
+COUNTER_ID = "counter"
+
+
+# Add books and bump the shared counter from one worker process
+def worker(path, journal, worker_number, operations, results):
+    library = Library(open_storage(path, journal))
+    retries = 0
+    for number in range(operations):
+        # Adds never conflict; the lock makes each one see the others
+        library.add({"id": generate_id(), "title": f"Worker {worker_number} book {number}", "author": f"Worker {worker_number}", "year": 2000, "genre": "Stress", "content": "", "read": False})
+        # Updates retry on conflict, re-reading the book each time
+        while True:
+            library.refresh()
+            counter = library.get(COUNTER_ID)
+            try:
+                library.update(counter.with_changes(year=counter.year + 1))
+                break
+            except ConflictError:
+                retries += 1
+                library.load()
+    results.put(retries)
+
+
+# Run the workers against one library file and check nothing was lost
+def run(path, journal, workers, operations):
+    storage = open_storage(path, journal)
+    storage.save([{"id": COUNTER_ID, "title": "Counter", "author": "Stress", "year": 0, "genre": "Stress", "content": "", "read": False, "version": 1}])
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker, args=(path, journal, number, operations, results)) for number in range(workers)]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    retries = sum(results.get() for _ in processes)
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+
+    # Every add and every counter bump must have survived
+    books = open_storage(path, journal).load()
+    expected = workers * operations
+    counter = next(book for book in books if book["id"] == COUNTER_ID)
+    # Real checks rather than asserts, which python -O strips
+    if len(books) != expected + 1:
+        raise RuntimeError(f"lost adds: expected {expected + 1} books, found {len(books)}")
+    if counter["year"] != expected:
+        raise RuntimeError(f"lost updates: expected counter {expected}, found {counter['year']}")
+    # Each operation is one add plus one update
+    print(f"{os.path.basename(path)}{' (journal)' if journal else ''}: {expected * 2} writes from {workers} workers in {elapsed:.2f}s ({expected * 2 / elapsed:,.0f} writes/sec, {retries} conflict retries), no lost writes")
+
+
+# Read one shared library from several threads while the background writer changes it, as Streamlit sessions do
+def run_shared(path, readers, operations):
+    # Imported here so the process-based runs above do not start a writer thread
+    from background_writer import get_writer
+    from library_cache import get_library
+    open_storage(path).save([{"id": f"seed-{number}", "title": f"Seed {number}", "author": "Stress", "year": 2000, "genre": "Stress", "content": "stress seed", "read": False, "version": 1} for number in range(operations)])
+    library = get_library(path)
+    writer = get_writer(path)
+    errors = []
+    reads = [0]
+    done = threading.Event()
+
+    # The reads a page makes, over and over until every change is saved
+    def reader():
+        while not done.is_set():
+            try:
+                library.search("stress", 10)
+                books, total = library.page(0, 20, "title")
+                for book in books:
+                    library.full(book)
+                library.values("author")
+                library.count(read=False)
+                library.stats.summary()
+                reads[0] += 1
+            except Exception as error:
+                errors.append(repr(error))
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for number in range(operations):
+        writer.submit("stress", "add", Book(f"new-{number}", f"New {number}", "Stress", 2001, "Stress", False, content="stress new"))
+        writer.submit("stress", "update", library.get(f"seed-{number}").with_changes(read=True))
+        writer.submit("stress", "remove", f"seed-{number}")
+    writer.flush()
+    done.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    writer.close()
+
+    # No read may have failed, and every queued change must have been saved
+    failures = writer.failures("stress")
+    if errors or failures:
+        raise RuntimeError(f"{len(errors)} reader errors (first: {errors[:1]}), writer failures: {failures[:3]}")
+    books = open_storage(path).load()
+    if sorted(book["id"] for book in books) != sorted(f"new-{number}" for number in range(operations)):
+        raise RuntimeError(f"expected exactly the {operations} new books, found {len(books)} books")
+    print(f"{os.path.basename(path)}: {reads[0]:,} page reads from {readers} threads during {operations * 3} queued changes in {elapsed:.2f}s, no reader errors")
+
+
+# Hammer each backend with concurrent writers
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent write stress test for the library storage")
+    parser.add_argument("--workers", type=int, default=8, help="Number of writer processes")
+    parser.add_argument("--operations", type=int, default=50, help="Adds and updates per worker")
+    parser.add_argument("--readers", type=int, default=4, help="Reader threads on the shared library")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        run(os.path.join(directory, "library.json"), False, args.workers, args.operations)
+        run(os.path.join(directory, "journal.json"), True, args.workers, args.operations)
+        run(os.path.join(directory, "library.db"), False, args.workers, args.operations)
+        run_shared(os.path.join(directory, "shared.json"), args.readers, args.operations)
+        run_shared(os.path.join(directory, "shared.db"), args.readers, args.operations)
@@ -0,0 +1,199 @@
+import bisect  # Import bisect to find the histogram bucket for a latency
+import collections  # Import collections for the bounded slow-operation log
+import functools  # Import functools to keep the names of timed functions
+import json  # Import the json module to save metrics between CLI runs
+import os  # Import the os module to read the telemetry settings
+import threading  # Import threading so Streamlit sessions can record at the same time
+import time  # Import time to measure latency
+
+# Telemetry is off unless LIBRARY_TELEMETRY=1 is set or enable() is called; when off, every hook returns at once
+enabled = os.environ.get("LIBRARY_TELEMETRY") == "1"
+
+# Operations slower than this many milliseconds go to the slow-operation log
+slow_ms = float(os.environ.get("LIBRARY_SLOW_MS", "500"))
+
+# Upper bounds of the latency histogram buckets in milliseconds; the last bucket takes everything slower
+BUCKETS_MS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+# Number of slow operations kept for display
+SLOW_LOG_SIZE = 100
+
+# Guards the metrics below
+_lock = threading.Lock()
+
+# For each timed operation: call count, total and maximum milliseconds, and histogram bucket counts
+_timings = {}
+
+# Plain counters, e.g. records loaded or bytes written
+_counters = collections.Counter()
+
+# Most recent slow operations, newest last
+_slow = collections.deque(maxlen=SLOW_LOG_SIZE)
+
+
+# Turn telemetry on or off at runtime
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+# Change the slow-operation threshold in milliseconds
+def set_slow_threshold(milliseconds):
+    global slow_ms
+    slow_ms = float(milliseconds)
+
+
+# Add to a counter
+def count(name, amount=1):
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] += amount
+
+
+# Record one call of an operation that took the given number of seconds
+def record(name, seconds):
+    if not enabled:
+        return
+    milliseconds = seconds * 1000
+    with _lock:
+        timing = _timings.get(name)
+        if timing is None:
+            timing = _timings[name] = {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "buckets": [0] * (len(BUCKETS_MS) + 1)}
+        timing["count"] += 1
+        timing["total_ms"] += milliseconds
+        timing["max_ms"] = max(timing["max_ms"], milliseconds)
+        timing["buckets"][bisect.bisect_left(BUCKETS_MS, milliseconds)] += 1
+        if milliseconds >= slow_ms:
+            _slow.append({"operation": name, "ms": round(milliseconds, 3), "at": time.strftime("%Y-%m-%d %H:%M:%S")})
+    if milliseconds >= slow_ms:
+        # Imported on the first slow operation, so startup does not pay for logging
+        import logging
+        logging.getLogger("library.telemetry").warning("Slow operation: %s took %.1f ms (threshold %.0f ms)", name, milliseconds, slow_ms)
+
+
+# Context manager that records how long its block took
+class Timer:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, time.perf_counter() - self.start)
+
+
+# Stand-in used while telemetry is off, so a disabled timer costs one call
+class NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_null_timer = NullTimer()
+
+
+# Time a block: with timer("search"): ...
+def timer(name):
+    return Timer(name) if enabled else _null_timer
+
+
+# Time every call of a function: @timed("json.save")
+def timed(name):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+# Estimate a percentile from the histogram as the upper bound of the bucket it falls in
+def bucket_percentile(buckets, share, max_ms):
+    target = share * sum(buckets)
+    seen = 0
+    for bound, bucket in zip(BUCKETS_MS, buckets):
+        seen += bucket
+        if seen >= target:
+            return min(bound, max_ms)
+    return max_ms
+
+
+# All metrics as plain data, ready for printing, JSON output or saving
+def snapshot():
+    with _lock:
+        timings = {name: {**timing, "buckets": list(timing["buckets"])} for name, timing in _timings.items()}
+        return {"timings": timings, "counters": dict(_counters), "slow": list(_slow)}
+
+
+# Summarize a snapshot per operation: calls, mean, estimated p50/p95 and maximum latency, slowest total first
+def summarize(metrics):
+    rows = []
+    for name, timing in metrics["timings"].items():
+        rows.append({
+            "operation": name,
+            "count": timing["count"],
+            "total_ms": round(timing["total_ms"], 3),
+            "mean_ms": round(timing["total_ms"] / timing["count"], 3),
+            "p50_ms": bucket_percentile(timing["buckets"], 0.50, round(timing["max_ms"], 3)),
+            "p95_ms": bucket_percentile(timing["buckets"], 0.95, round(timing["max_ms"], 3)),
+            "max_ms": round(timing["max_ms"], 3),
+        })
+    return sorted(rows, key=lambda row: row["total_ms"], reverse=True)
+
+
+# Forget everything recorded so far
+def reset():
+    with _lock:
+        _timings.clear()
+        _counters.clear()
+        _slow.clear()
+
+
+# Combine two snapshots, e.g. this process's metrics with the ones saved by earlier CLI runs
+def merge(first, second):
+    timings = {name: {**timing, "buckets": list(timing["buckets"])} for name, timing in first["timings"].items()}
+    for name, timing in second["timings"].items():
+        if name not in timings:
+            timings[name] = {**timing, "buckets": list(timing["buckets"])}
+            continue
+        merged = timings[name]
+        merged["count"] += timing["count"]
+        merged["total_ms"] += timing["total_ms"]
+        merged["max_ms"] = max(merged["max_ms"], timing["max_ms"])
+        merged["buckets"] = [a + b for a, b in zip(merged["buckets"], timing["buckets"])]
+    counters = collections.Counter(first["counters"])
+    counters.update(second["counters"])
+    slow = (first["slow"] + second["slow"])[-SLOW_LOG_SIZE:]
+    return {"timings": timings, "counters": dict(counters), "slow": slow}
+
+
+# Read metrics saved by earlier runs, or empty metrics if there are none
+def load(path):
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"timings": {}, "counters": {}, "slow": []}
+
+
+# Add this process's metrics to the ones saved at a path, so short CLI runs add up
+def save(path):
+    # Imported here because storage itself is instrumented with this module
+    from storage import file_lock, write_json_atomic
+    with file_lock(path):
+        write_json_atomic(path, merge(load(path), snapshot()))